@@ -17,7 +17,8 @@ import { Injectable } from '@angular/core';
 import { HttpClient, HttpParams } from '@angular/common/http';
 import 'rxjs/add/observable/of';
 import 'rxjs/add/operator/catch';
-import { BehaviorSubject, Observable } from 'rxjs';
+import { BehaviorSubject, Observable, of, throwError, timer } from 'rxjs';
+import { filter, switchMap, take } from 'rxjs/operators';
 import {
   Asset,
   TextAsset,
@@ -29,6 +30,8 @@ import {
 import { UpdateResponse, STATUS } from '../model/response';
 import { Account, AccountAGs } from './../model/account';
 
+const JOB_POLL_INTERVAL = 2000;
+
 @Injectable({
   providedIn: 'root',
 })
@@ -108,9 +111,25 @@ export class AssetService {
     return this._http.get<Account[]>(endpoint);
   }
 
+  /** Starts a structure refresh job and emits once it has finished */
   loadMccStruct(): Observable<any> {
     const endpoint = this.API_SERVER + '/create-struct/';
-    return this._http.get(endpoint);
+    return this._http.get<any>(endpoint).pipe(
+      switchMap((job) =>
+        timer(0, JOB_POLL_INTERVAL).pipe(
+          switchMap(() =>
+            this._http.get<any>(this.API_SERVER + '/jobs/' + job.id + '/')
+          ),
+          filter((status) => status.status == 'done' || status.status == 'failed'),
+          take(1)
+        )
+      ),
+      switchMap((job) =>
+        job.status == 'failed'
+          ? throwError({ status: 403, error: job.error })
+          : of(job)
+      )
+    );
   }
 
   changeAsset(asset: Asset) {
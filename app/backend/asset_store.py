@@ -0,0 +1,506 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory asset to ad groups store, part of the assetMG tool.
+
+The store is loaded once from asset_to_ag.json and keeps its entries indexed by
+(asset id, performance type), by ad group, campaign and account, and by the
+fields /assets-to-ag/ filters on, so mutations and lookups don't need to load
+and scan the whole file. Changes are appended to a
+journal next to asset_to_ag.json, which is folded into the file once it grows.
+
+Set ASSETMG_CACHE_BACKEND=sqlite to keep the store in a SQLite database
+instead (see sqlite_store).
+"""
+
+import bisect
+import contextlib
+import logging
+import os
+import threading
+from pathlib import Path
+from app.backend import cache_files
+
+
+ASSET_TO_AG_JSON_PATH = Path('app/cache/asset_to_ag.json')
+ACCOUNT_STRUCT_JSON_PATH = Path('app/cache/account_struct.json')
+SQLITE_DB_PATH = Path('app/cache/assetmg.db')
+CACHE_BACKEND = os.environ.get('ASSETMG_CACHE_BACKEND', 'json')
+
+# journal records after which save() rewrites asset_to_ag.json
+COMPACT_AFTER = 1000
+DEFAULT_PAGE_SIZE = 500
+SORT_FIELDS = ['index', 'id', 'name', 'type']
+# value used for entries that don't have the sort field
+SORT_DEFAULTS = {'id': 0, 'name': '', 'type': ''}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def performance_type(asset):
+  """Returns the performance type an asset entry is keyed by."""
+  if asset['type'] == 'TEXT':
+    return asset['text_type']
+  return 'nontext'
+
+
+class AssetStore(object):
+  """Asset to ad groups entries, indexed for O(1) lookups.
+
+  Entries keep the order of asset_to_ag.json, as the frontend refers to them
+  by their index in /assets-to-ag/.
+  """
+
+  def __init__(self, assets_file, structure_file=None):
+    self._assets_file = assets_file
+    self._structure_file = structure_file
+    self._lock = threading.RLock()
+    self._version = 0
+    self._pending = []
+    self._journal_size = 0
+    self._refreshing = False
+    self.reload()
+
+  def reload(self):
+    """Reloads the store from the cache files and the journal.
+
+    Runs under the store's lock, changes made by other threads are either in
+    the journal it reads or wait for it.
+    """
+    with self._lock:
+      self._append_pending()
+      try:
+        entries = cache_files.read_list(self._assets_file)
+      except (FileNotFoundError, ValueError):
+        logging.warning('asset_to_ag.json not available, starting empty store')
+        entries = []
+      journal = cache_files.read_journal(self._assets_file)
+
+      ad_group_accounts = {}
+      ad_group_campaigns = {}
+      if self._structure_file:
+        try:
+          structure = cache_files.read_structure(self._structure_file)
+        except (FileNotFoundError, ValueError):
+          structure = []
+        for account in structure:
+          for campaign in account['campaigns']:
+            for ad_group in campaign['adgroups']:
+              ad_group_accounts[ad_group['id']] = account['id']
+              ad_group_campaigns[ad_group['id']] = campaign['id']
+
+      self._version += 1
+      self._entries = []
+      self._index = {}
+      self._links = {}
+      self._by_ad_group = {}
+      self._by_account = {}
+      self._by_campaign = {}
+      self._by_type = {}
+      self._by_text_type = {}
+      self._by_performance = {}
+      self._sorted = {}
+      self._ad_group_accounts = ad_group_accounts
+      self._ad_group_campaigns = ad_group_campaigns
+      for entry in entries:
+        self._put(entry, None)
+      for record in journal:
+        self._replay(record)
+      self._journal_size = len(journal)
+
+  @contextlib.contextmanager
+  def refreshing(self):
+    """Wraps a refresh that rebuilds the cache files.
+
+    The store is written to asset_to_ag.json for the refresh to build on.
+    Changes made during the refresh only go to the journal, so they don't
+    overwrite the refreshed file, and are applied on top of it when the store
+    is reloaded at the end.
+    """
+    with self._lock:
+      self.flush()
+      self._refreshing = True
+    try:
+      yield
+    finally:
+      with self._lock:
+        self._refreshing = False
+        self.reload()
+
+  def _replay(self, record):
+    """Applies a journal record."""
+    if record['op'] == 'put':
+      self._put(record['entry'], None)
+    elif record['op'] == 'add_links':
+      self._add_links(record['entry'], record['links'])
+    elif record['op'] == 'remove_links':
+      self._remove_links(
+          record['id'], record['performance_type'], record['ad_group_ids'])
+    else:
+      raise ValueError('unknown journal record: ' + record['op'])
+
+  def _put(self, entry, index):
+    self._version += 1
+    key = (entry['id'], performance_type(entry))
+    if index is None:
+      index = self._index.get(key)
+    if index is None:
+      index = len(self._entries)
+      self._entries.append(entry)
+    else:
+      old = self._entries[index]
+      old_key = (old['id'], performance_type(old))
+      self._unlink(old_key)
+      self._by_type[old['type']].discard(old_key)
+      self._by_text_type[old.get('text_type')].discard(old_key)
+      self._count_performance(old_key, old, -1)
+      if old_key != key:
+        del self._index[old_key]
+      self._entries[index] = entry
+    self._index[key] = index
+    self._by_type.setdefault(entry['type'], set()).add(key)
+    self._by_text_type.setdefault(entry.get('text_type'), set()).add(key)
+    self._count_performance(key, entry, 1)
+    self._link(key, {ad_group['id'] for ad_group in entry['adgroups']})
+    return index
+
+  def _count_performance(self, key, entry, delta):
+    for ad_group in entry['adgroups']:
+      _count(self._by_performance, ad_group.get('performance'), key, delta)
+
+  def _link(self, key, ad_group_ids):
+    self._links[key] = ad_group_ids
+    for ad_group_id in ad_group_ids:
+      self._by_ad_group.setdefault(ad_group_id, set()).add(key)
+      _count(self._by_account, self._ad_group_accounts.get(ad_group_id), key, 1)
+      _count(
+          self._by_campaign, self._ad_group_campaigns.get(ad_group_id), key, 1)
+
+  def _unlink(self, key):
+    for ad_group_id in self._links.pop(key, ()):
+      self._by_ad_group[ad_group_id].discard(key)
+      _count(
+          self._by_account, self._ad_group_accounts.get(ad_group_id), key, -1)
+      _count(
+          self._by_campaign, self._ad_group_campaigns.get(ad_group_id), key, -1)
+
+  def _copy(self, index):
+    entry = self._entries[index]
+    return dict(entry, adgroups=list(entry['adgroups']))
+
+  def get(self, asset_id, perf_type):
+    """Returns the (index, entry) of an asset, or (None, None).
+
+    The entry is a copy, changes are applied with put().
+    """
+    with self._lock:
+      index = self._index.get((asset_id, perf_type))
+      if index is None:
+        return None, None
+      return index, self._copy(index)
+
+  def find(self, asset_id):
+    """Returns the (index, entry) of every performance type of an asset."""
+    with self._lock:
+      return [(self._index[key], self._copy(self._index[key]))
+              for key in [(asset_id, 'nontext'), (asset_id, 'headlines'),
+                          (asset_id, 'descriptions')]
+              if key in self._index]
+
+  def put(self, entry, index=None):
+    """Adds or replaces an entry and returns its index.
+
+    If index is not given, the entry with the same asset id and performance
+    type is replaced, if there is one.
+    """
+    with self._lock:
+      index = self._put(entry, index)
+      self._pending.append({'op': 'put', 'entry': entry})
+      return index
+
+  def add_links(self, entry, links):
+    """Links an asset to ad groups, returns its (index, entry).
+
+    The asset is added from entry if the store doesn't have it yet. Ad groups
+    the asset is already linked to are skipped. The change is applied
+    atomically, so concurrent changes to the same asset are all kept.
+
+    Args:
+      entry: the asset's entry, its adgroups are ignored.
+      links: the ad group links to add, dicts with the ad group's 'id'.
+    """
+    with self._lock:
+      entry = dict(entry, adgroups=[])
+      index, changed = self._add_links(entry, links)
+      if changed:
+        self._pending.append(
+            {'op': 'add_links', 'entry': entry, 'links': links})
+      return index, self._copy(index)
+
+  def _add_links(self, entry, links):
+    key = (entry['id'], performance_type(entry))
+    index = self._index.get(key)
+    if index is not None:
+      entry = self._entries[index]
+    linked = set(self._links.get(key, ()))
+    added = []
+    for link in links:
+      if link['id'] not in linked:
+        linked.add(link['id'])
+        added.append(link)
+    if index is not None and not added:
+      return index, False
+    return self._put(dict(entry, adgroups=entry['adgroups'] + added),
+                     index), True
+
+  def remove_links(self, asset_id, perf_type, ad_group_ids):
+    """Unlinks an asset from ad groups, atomically.
+
+    Returns the (index, entry) of the asset, or (None, None) if the store
+    doesn't have it.
+    """
+    with self._lock:
+      index, changed = self._remove_links(asset_id, perf_type, ad_group_ids)
+      if index is None:
+        return None, None
+      if changed:
+        self._pending.append({
+            'op': 'remove_links', 'id': asset_id, 'performance_type': perf_type,
+            'ad_group_ids': list(ad_group_ids)})
+      return index, self._copy(index)
+
+  def _remove_links(self, asset_id, perf_type, ad_group_ids):
+    index = self._index.get((asset_id, perf_type))
+    if index is None:
+      return None, False
+    entry = self._entries[index]
+    ad_group_ids = set(ad_group_ids)
+    adgroups = [ad_group for ad_group in entry['adgroups']
+                if ad_group['id'] not in ad_group_ids]
+    if len(adgroups) == len(entry['adgroups']):
+      return index, False
+    return self._put(dict(entry, adgroups=adgroups), index), True
+
+  def assign_account(self, ad_group_id, account_id):
+    """Records the account of an ad group, for the by-account index."""
+    with self._lock:
+      if self._ad_group_accounts.get(ad_group_id) == account_id:
+        return
+      links = {key: self._links[key]
+               for key in self._by_ad_group.get(ad_group_id, ())}
+      for key in links:
+        self._unlink(key)
+      self._ad_group_accounts[ad_group_id] = account_id
+      for key, ad_group_ids in links.items():
+        self._link(key, ad_group_ids)
+
+  def by_ad_group(self, ad_group_id):
+    """Returns the entries of all assets assigned to the ad group."""
+    with self._lock:
+      return [self._copy(self._index[key])
+              for key in self._by_ad_group.get(ad_group_id, ())]
+
+  def by_account(self, account_id):
+    """Returns the entries of all assets assigned to the account's ad groups."""
+    with self._lock:
+      return [self._copy(self._index[key])
+              for key in self._by_account.get(account_id, {})]
+
+  def entries(self):
+    """Returns all entries, in index order."""
+    with self._lock:
+      return list(self._entries)
+
+  def _sort_item(self, sort, index):
+    entry = self._entries[index]
+    if sort == 'index':
+      return (index, index)
+    return (entry.get(sort) or SORT_DEFAULTS[sort], index)
+
+  def _sorted_items(self, sort):
+    """Returns the (sort value, index) of all entries, sorted.
+
+    The order is computed once per store version.
+    """
+    cached = self._sorted.get(sort)
+    if cached is None or cached[0] != self._version:
+      cached = (self._version, sorted(
+          self._sort_item(sort, index) for index in range(len(self._entries))))
+      self._sorted[sort] = cached
+    return cached[1]
+
+  def query(self, filters=None, sort='index', descending=False, cursor=None,
+            limit=DEFAULT_PAGE_SIZE):
+    """Returns a page of the entries that match the filters.
+
+    Args:
+      filters: dict with any of 'account', 'campaign', 'adgroup', 'type',
+        'text_type' and 'performance'. Entries match if any of their ad groups
+        is in the account/campaign/adgroup and has the performance label.
+      sort: one of SORT_FIELDS.
+      descending: sort order.
+      cursor: the next_cursor of the previous page.
+      limit: max number of entries, at least 1.
+    Returns:
+      tuple of the page's entries, each with its 'index', and the cursor of
+      the next page, or None if this is the last page.
+    Raises:
+      ValueError: if sort or limit are invalid.
+    """
+    if sort not in SORT_FIELDS:
+      raise ValueError('unknown sort field: ' + sort)
+    if limit < 1:
+      raise ValueError('limit must be at least 1')
+    filters = filters or {}
+    with self._lock:
+      candidates = None
+      for keys in [
+          self._by_account.get(filters['account'], {})
+          if 'account' in filters else None,
+          self._by_campaign.get(filters['campaign'], {})
+          if 'campaign' in filters else None,
+          self._by_ad_group.get(filters['adgroup'], set())
+          if 'adgroup' in filters else None,
+          self._by_type.get(filters['type'], set())
+          if 'type' in filters else None,
+          self._by_text_type.get(filters['text_type'], set())
+          if 'text_type' in filters else None,
+          self._by_performance.get(filters['performance'], {})
+          if 'performance' in filters else None]:
+        if keys is not None:
+          candidates = (set(keys) if candidates is None
+                        else candidates.intersection(keys))
+
+      if candidates is None:
+        items = self._sorted_items(sort)
+      else:
+        items = sorted(self._sort_item(sort, self._index[key])
+                       for key in candidates)
+
+      position = 0
+      if cursor is not None:
+        position = bisect.bisect_right(items, tuple(cursor))
+      if descending:
+        position = len(items)
+        if cursor is not None:
+          position = bisect.bisect_left(items, tuple(cursor))
+        items = reversed(items[:position])
+      else:
+        items = items[position:]
+
+      page = []
+      in_scope = self._ad_group_scope(filters)
+      for item in items:
+        if _matches(self._entries[item[1]], filters, in_scope):
+          if len(page) == limit:
+            return page, list(page_end)
+          page.append(dict(self._copy(item[1]), index=item[1]))
+          page_end = item
+      return page, None
+
+  def _ad_group_scope(self, filters):
+    """Returns a filter for the ad groups in the filters' scope."""
+    def in_scope(ad_group_id):
+      return (
+          filters.get('adgroup', ad_group_id) == ad_group_id
+          and filters.get('campaign', self._ad_group_campaigns.get(
+              ad_group_id)) == self._ad_group_campaigns.get(ad_group_id)
+          and filters.get('account', self._ad_group_accounts.get(
+              ad_group_id)) == self._ad_group_accounts.get(ad_group_id))
+    return in_scope
+
+  def version(self):
+    """Returns a token that changes whenever the stored data changes."""
+    try:
+      structure_version = os.stat(self._structure_file).st_mtime_ns
+    except (FileNotFoundError, TypeError):
+      structure_version = 0
+    return '%d-%d' % (self._version, structure_version)
+
+  def save(self):
+    """Appends the changes since the last save to the journal.
+
+    Once the journal holds COMPACT_AFTER records, it is folded into
+    asset_to_ag.json, unless a refresh is rebuilding the file.
+    """
+    with self._lock:
+      self._append_pending()
+      if self._journal_size >= COMPACT_AFTER and not self._refreshing:
+        self.flush()
+
+  def _append_pending(self):
+    if self._pending:
+      cache_files.append_journal(self._assets_file, self._pending)
+      self._journal_size += len(self._pending)
+      self._pending = []
+
+  def flush(self):
+    """Writes the store back to asset_to_ag.json and clears the journal."""
+    with self._lock:
+      cache_files.write_list(self._assets_file, self._entries)
+      cache_files.clear_journal(self._assets_file)
+      self._pending = []
+      self._journal_size = 0
+
+  def get_structure(self):
+    """Returns the structure of all accounts."""
+    return cache_files.read_structure(self._structure_file)
+
+  def get_account(self, account_id):
+    """Returns the structure of a single account, or None."""
+    return cache_files.read_account(self._structure_file, account_id)
+
+
+def _matches(entry, filters, in_scope):
+  """Checks an entry against the filters.
+
+  One of the entry's ad groups has to match all of the ad group filters. The
+  entry's own fields are already filtered by the indexes.
+  """
+  if not any(key in filters
+             for key in ('account', 'campaign', 'adgroup', 'performance')):
+    return True
+  return any(
+      in_scope(ad_group['id'])
+      and filters.get('performance', ad_group.get('performance'))
+      == ad_group.get('performance')
+      for ad_group in entry['adgroups'])
+
+
+def _count(index, scope, key, delta):
+  """Counts the links of key within scope (e.g. an account or a campaign)."""
+  if scope is None:
+    return
+  keys = index.setdefault(scope, {})
+  keys[key] = keys.get(key, 0) + delta
+  if not keys[key]:
+    del keys[key]
+
+
+def get_store():
+  """Returns the configured asset store, loading it on first use."""
+  global _store
+  with _store_lock:
+    if _store is None:
+      # cache files written in another format are converted once
+      cache_files.migrate(ACCOUNT_STRUCT_JSON_PATH, structure=True)
+      cache_files.migrate(ASSET_TO_AG_JSON_PATH)
+      if CACHE_BACKEND == 'sqlite':
+        from app.backend.sqlite_store import SqliteStore
+        _store = SqliteStore(
+            SQLITE_DB_PATH, ASSET_TO_AG_JSON_PATH, ACCOUNT_STRUCT_JSON_PATH)
+      else:
+        _store = AssetStore(ASSET_TO_AG_JSON_PATH, ACCOUNT_STRUCT_JSON_PATH)
+    return _store
@@ -0,0 +1,285 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reading and writing of the structure cache files.
+
+account_struct.json and asset_to_ag.json are lists, written in the format
+configured with ASSETMG_CACHE_FORMAT (see serialization) and read in whatever
+format they are in. Next to account_struct.json an index file maps every
+account id to the byte offset and length of its entry, so a single account is
+read with one seek instead of parsing the whole file.
+
+Cache files are written to a temp file that then replaces the old one, so
+readers always see either the old or the new file, never a partial one. Lists
+are written one item at a time, so they don't have to be held in memory.
+
+Small changes to a list file can be appended to a journal next to it instead
+of rewriting the whole file, see append_journal.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from app.backend import serialization
+
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+def index_path(path):
+  path = Path(path)
+  return path.parent / (path.name + '.idx')
+
+
+def journal_path(path):
+  path = Path(path)
+  return path.parent / (path.name + '.journal')
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+  """Opens a temp file that replaces path once it is closed without errors."""
+  path = Path(path)
+  fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + '.')
+  try:
+    with os.fdopen(fd, mode) as f:
+      yield f
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.unlink(tmp_path)
+    raise
+
+
+def write_json(path, data, indent=2):
+  """Atomically writes data to a JSON file."""
+  with atomic_write(path) as f:
+    json.dump(data, f, indent=indent)
+
+
+def write_list(path, items):
+  """Atomically writes a list in the configured format, one item at a time."""
+  with list_writer(path) as add:
+    for item in items:
+      add(item)
+
+
+def write_structure(path, accounts):
+  """Writes the accounts structure as a list, along with its index.
+
+  accounts can be any iterable, every account is serialized as it is written.
+  """
+  with structure_writer(path) as add:
+    for account in accounts:
+      add(account)
+
+
+@contextlib.contextmanager
+def list_writer(path):
+  """Atomically writes a list in the configured format, one item at a time.
+
+  Yields a function that writes an item. The file replaces path when the
+  block exits without errors, and is discarded otherwise.
+  """
+  with atomic_write(path, 'wb') as f:
+    writer = serialization.get_format().list_writer(f)
+    yield writer.add
+    writer.close()
+
+
+@contextlib.contextmanager
+def structure_writer(path):
+  """Atomically writes the accounts structure, one account at a time.
+
+  Like list_writer, and writes the index of the accounts once the structure
+  file is in place. The index records the size and mtime of the structure
+  file it belongs to, so it is ignored if the structure file is swapped
+  without it.
+  """
+  index = {}
+  with list_writer(path) as add_item:
+    def add(account):
+      index[str(account['id'])] = list(add_item(account))
+    yield add
+
+  stat = os.stat(path)
+  write_json(index_path(path), {
+      'size': stat.st_size,
+      'mtime': stat.st_mtime_ns,
+      'accounts': index,
+  }, indent=None)
+
+
+def migrate(path, structure=False):
+  """Rewrites a list cache file in the configured format, if it isn't in it.
+
+  Args:
+    path: the cache file, nothing is done if it doesn't exist.
+    structure: whether it is the accounts structure, which has an index.
+  """
+  target = serialization.get_format()
+  try:
+    current = serialization.file_format(path)
+    if current is target:
+      return
+    items = serialization.load(path)
+  except FileNotFoundError:
+    return
+  except ValueError:
+    logging.warning('Could not read %s, not migrating it', path)
+    return
+  logging.info('Migrating %s from %s to %s', path, current.name, target.name)
+  if structure:
+    write_structure(path, items)
+  else:
+    write_list(path, items)
+
+
+def age(path):
+  """Returns the seconds since path was last written, or None if missing."""
+  try:
+    return time.time() - os.stat(path).st_mtime
+  except FileNotFoundError:
+    return None
+
+
+def read_list(path):
+  """Returns the list in a cache file, whatever format it is in.
+
+  Raises:
+    FileNotFoundError: if there is no such file.
+    ValueError: if the file is corrupt.
+  """
+  return serialization.load(path)
+
+
+def iter_list(path):
+  """Returns an iterator over the list in a cache file, see read_list.
+
+  The file is opened right away, so a missing file raises here. Unlike
+  read_list, binary files are read one item at a time.
+  """
+  return serialization.iter_load(path)
+
+
+def append_journal(path, records):
+  """Appends records to the journal of a cache file, one JSON per line."""
+  # every record starts a new line, so one left partial by a crash while
+  # appending doesn't corrupt the records after it
+  data = ''.join('\n' + json.dumps(record) for record in records)
+  with open(journal_path(path), 'a') as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def read_journal(path):
+  """Returns the records in the journal of a cache file.
+
+  Partial records, left by a crash while appending, are skipped.
+  """
+  try:
+    with open(journal_path(path), 'r') as f:
+      lines = f.read().split('\n')
+  except FileNotFoundError:
+    return []
+  records = []
+  for line in lines:
+    if not line:
+      continue
+    try:
+      records.append(json.loads(line))
+    except ValueError:
+      logging.warning('Skipping partial record in %s', journal_path(path))
+  return records
+
+
+def clear_journal(path):
+  """Removes the journal of a cache file, once it is folded into the file."""
+  try:
+    os.unlink(journal_path(path))
+  except FileNotFoundError:
+    pass
+
+
+def read_structure(path):
+  """Returns the structure of all accounts."""
+  return read_list(path)
+
+
+def _load_index(path):
+  """Returns the offsets index of the structure file, or None if stale."""
+  try:
+    index_mtime = os.stat(index_path(path)).st_mtime_ns
+    stat = os.stat(path)
+  except FileNotFoundError:
+    return None
+
+  with _index_lock:
+    cached = _index_cache.get(str(path))
+    if not cached or cached[0] != index_mtime:
+      with open(index_path(path), 'r') as f:
+        cached = (index_mtime, json.load(f))
+      _index_cache[str(path)] = cached
+
+  index = cached[1]
+  if (index['size'] != stat.st_size
+      or index.get('mtime', stat.st_mtime_ns) != stat.st_mtime_ns):
+    return None
+  return index['accounts']
+
+
+def account_ids(path):
+  """Returns the ids of the accounts in the structure file.
+
+  If the file has no valid index, for instance because it was written before
+  indexes existed, it is rewritten along with one.
+
+  Raises:
+    FileNotFoundError: if there is no such file.
+    ValueError: if the file is corrupt.
+  """
+  index = _load_index(path)
+  if index is None:
+    logging.info('No index for %s, rewriting it with one', path)
+    write_structure(path, read_structure(path))
+    index = _load_index(path)
+  return [int(account_id) for account_id in index]
+
+
+def read_account(path, account_id):
+  """Returns the structure of a single account, or None if it isn't there."""
+  index = _load_index(path)
+  if index is None:
+    logging.info('No index for %s, reading the whole file', path)
+    for account in read_structure(path):
+      if account['id'] == account_id:
+        return account
+    return None
+
+  location = index.get(str(account_id))
+  if location is None:
+    return None
+  offset, length = location
+  with open(path, 'rb') as f:
+    file_format = serialization.detect(f)
+    f.seek(offset)
+    return file_format.loads_item(f.read(length))
@@ -0,0 +1,162 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background jobs, used for the structure refreshes.
+
+A job runs in its own thread and reports per-account progress. Jobs are keyed,
+submitting a job while another job with the same key is running returns the
+running job instead of starting a new one.
+"""
+
+import collections
+import logging
+import threading
+import time
+import uuid
+
+
+MAX_FINISHED_JOBS = 20
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job(object):
+  """A background job and its progress."""
+
+  def __init__(self, key, description):
+    self.id = uuid.uuid4().hex
+    self.key = key
+    self.description = description
+    self.status = PENDING
+    self.error = None
+    self.result = None
+    self.created = time.time()
+    self.started = None
+    self.finished = None
+    self._accounts = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def progress(self, account_id, status):
+    """Records the status of an account, called by the job's function."""
+    now = time.time()
+    with self._lock:
+      account = self._accounts.setdefault(
+          account_id, {'id': account_id, 'status': PENDING})
+      if status == RUNNING:
+        account['started'] = now
+        account.pop('finished', None)
+        account.pop('seconds', None)
+      elif status in (DONE, FAILED):
+        account['finished'] = now
+        account['seconds'] = round(now - account.get('started', now), 3)
+      account['status'] = status
+
+  def to_dict(self):
+    with self._lock:
+      accounts = [dict(account) for account in self._accounts.values()]
+    counts = collections.Counter(account['status'] for account in accounts)
+    end = self.finished or time.time()
+    return {
+        'id': self.id,
+        'description': self.description,
+        'status': self.status,
+        'error': self.error,
+        'result': self.result,
+        'created': self.created,
+        'started': self.started,
+        'finished': self.finished,
+        'seconds': round(end - self.started, 3) if self.started else None,
+        'progress': {
+            'total': len(accounts),
+            'done': counts[DONE],
+            'failed': counts[FAILED],
+            'running': counts[RUNNING],
+        },
+        'accounts': accounts,
+    }
+
+
+class JobManager(object):
+  """Runs jobs in background threads and keeps track of them."""
+
+  def __init__(self, max_finished=MAX_FINISHED_JOBS):
+    self._max_finished = max_finished
+    self._jobs = collections.OrderedDict()
+    self._running = {}
+    self._lock = threading.Lock()
+
+  def submit(self, key, description, fn):
+    """Starts fn(job) in the background.
+
+    Args:
+      key: jobs with the same key don't run concurrently.
+      description: shown in the job's status.
+      fn: function of the job, reports progress with job.progress(). Its
+        JSON serializable return value is the job's result.
+    Returns:
+      tuple of the job and whether it was started by this call. If a job with
+      the same key is running, it is returned instead.
+    """
+    with self._lock:
+      running = self._running.get(key)
+      if running:
+        logging.info('Job %s is already running, joining it', running.id)
+        return running, False
+      job = Job(key, description)
+      self._running[key] = job
+      self._jobs[job.id] = job
+      self._trim()
+
+    thread = threading.Thread(
+        target=self._run, args=(job, fn), name='job-' + job.id, daemon=True)
+    thread.start()
+    return job, True
+
+  def _run(self, job, fn):
+    job.started = time.time()
+    job.status = RUNNING
+    logging.info('Started job %s: %s', job.id, job.description)
+    try:
+      job.result = fn(job)
+    except Exception as e:
+      logging.exception('Job %s failed', job.id)
+      job.error = str(e)
+      job.status = FAILED
+    else:
+      job.status = DONE
+    finally:
+      job.finished = time.time()
+      with self._lock:
+        self._running.pop(job.key, None)
+    logging.info('Job %s %s in %.1fs', job.id, job.status,
+                 job.finished - job.started)
+
+  def _trim(self):
+    finished = [job_id for job_id, job in self._jobs.items()
+                if job.finished is not None]
+    for job_id in finished[:max(0, len(finished) - self._max_finished)]:
+      del self._jobs[job_id]
+
+  def get(self, job_id):
+    """Returns the job, or None if it is unknown."""
+    with self._lock:
+      return self._jobs.get(job_id)
+
+  def running(self, key):
+    """Returns the running job of key, or None."""
+    with self._lock:
+      return self._running.get(key)
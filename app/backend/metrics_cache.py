@@ -0,0 +1,188 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-day cache of asset x ad group metrics, for date range requests.
+
+Metrics are stored per account and day in a SQLite database. A date range only
+fetches the days that aren't cached yet, the rest is summed locally. The last
+few days, in the account's time zone, are always fetched again, as their
+metrics (conversions in particular) are still being updated.
+"""
+
+import datetime
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+
+METRICS_DB_PATH = Path('app/cache/metrics.db')
+# days this close to today are fetched on every request
+VOLATILE_DAYS = 3
+DATE_FORMAT = '%Y-%m-%d'
+
+METRICS = ['clicks', 'all_conversions', 'impressions', 'cost_micros']
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS days (
+      account_id INTEGER,
+      day TEXT,
+      PRIMARY KEY (account_id, day)
+    );
+    CREATE TABLE IF NOT EXISTS metrics (
+      account_id INTEGER,
+      day TEXT,
+      ad_group_id INTEGER,
+      asset_id INTEGER,
+      performance_type TEXT,
+      clicks INTEGER,
+      all_conversions REAL,
+      impressions INTEGER,
+      cost_micros INTEGER,
+      PRIMARY KEY (account_id, day, ad_group_id, asset_id, performance_type)
+    ) WITHOUT ROWID;
+'''
+
+_ONE_DAY = datetime.timedelta(days=1)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def parse_date_range(start, end):
+  """Returns the (start, end) dates of the from/to request params.
+
+  Raises:
+    ValueError: if the dates are invalid or end is before start.
+  """
+  start = datetime.datetime.strptime(start, DATE_FORMAT).date()
+  end = datetime.datetime.strptime(end, DATE_FORMAT).date()
+  if end < start:
+    raise ValueError('to is before from')
+  return start, end
+
+
+class MetricsCache(object):
+  """Daily asset x ad group metrics of every account, in SQLite."""
+
+  def __init__(self, db_file):
+    self._db_file = db_file
+    self._local = threading.local()
+    self._account_locks = {}
+    self._locks_lock = threading.Lock()
+    self._conn().executescript(_SCHEMA)
+
+  def _conn(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(str(self._db_file), timeout=30)
+      conn.execute('PRAGMA journal_mode=WAL')
+      self._local.conn = conn
+    return conn
+
+  def _account_lock(self, account_id):
+    with self._locks_lock:
+      return self._account_locks.setdefault(account_id, threading.Lock())
+
+  def _missing_ranges(self, account_id, start, end):
+    """Returns the (start, end) ranges of the days that need to be fetched."""
+    cached = {row[0] for row in self._conn().execute(
+        'SELECT day FROM days WHERE account_id = ? AND day BETWEEN ? AND ?',
+        (account_id, start.strftime(DATE_FORMAT),
+         end.strftime(DATE_FORMAT)))}
+    ranges = []
+    day = start
+    while day <= end:
+      if day.strftime(DATE_FORMAT) not in cached:
+        if ranges and ranges[-1][1] == day - _ONE_DAY:
+          ranges[-1] = (ranges[-1][0], day)
+        else:
+          ranges.append((day, day))
+      day += _ONE_DAY
+    return ranges
+
+  def _replace_days(self, account_id, start, end, rows, today):
+    """Replaces the metrics of the days between start and end."""
+    days = (start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))
+    settled = today - datetime.timedelta(days=VOLATILE_DAYS)
+    conn = self._conn()
+    with conn:
+      conn.execute(
+          'DELETE FROM metrics WHERE account_id = ? AND day BETWEEN ? AND ?',
+          (account_id,) + days)
+      conn.executemany(
+          'INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+          ((account_id,) + tuple(row) for row in rows))
+      day = start
+      while day <= min(end, settled):
+        conn.execute('INSERT OR IGNORE INTO days VALUES (?, ?)',
+                     (account_id, day.strftime(DATE_FORMAT)))
+        day += _ONE_DAY
+
+  def _ensure(self, account_id, start, end, fetch, today):
+    for range_start, range_end in self._missing_ranges(
+        account_id, start, end):
+      logging.info('Fetching metrics of %s from %s to %s', account_id,
+                   range_start, range_end)
+      self._replace_days(account_id, range_start, range_end,
+                         fetch(range_start, range_end), today)
+
+  def _sum(self, account_id, start, end, group_by, fetch, today):
+    account_id = int(account_id)
+    with self._account_lock(account_id):
+      self._ensure(account_id, start, end, fetch, today)
+      return self._conn().execute(
+          f'SELECT {group_by}, SUM(clicks), SUM(all_conversions), '
+          'SUM(impressions), SUM(cost_micros) FROM metrics '
+          'WHERE account_id = ? AND day BETWEEN ? AND ? '
+          f'GROUP BY {group_by}',
+          (account_id, start.strftime(DATE_FORMAT),
+           end.strftime(DATE_FORMAT))).fetchall()
+
+  def by_ad_group_asset(self, account_id, start, end, fetch, today):
+    """Returns the metrics of every asset in every ad group in the range.
+
+    Args:
+      account_id: the account's customer id.
+      start: first day (datetime.date) of the range.
+      end: last day of the range, inclusive.
+      fetch: function of (start, end) returning the metrics of the days that
+        aren't cached, as (day, ad group id, asset id, performance type,
+        clicks, all conversions, impressions, cost micros) rows.
+      today: the current date in the account's time zone. Days less than
+        VOLATILE_DAYS before it are fetched again on every request.
+    Returns:
+      dict of (ad group id, asset id, performance type) to a dict of METRICS.
+    """
+    rows = self._sum(account_id, start, end,
+                     'ad_group_id, asset_id, performance_type', fetch, today)
+    return {tuple(row[:3]): dict(zip(METRICS, row[3:])) for row in rows}
+
+  def by_asset(self, account_id, start, end, fetch, today):
+    """Returns the metrics of every asset in the range, see by_ad_group_asset.
+
+    Returns:
+      dict of asset id to a dict of METRICS.
+    """
+    rows = self._sum(account_id, start, end, 'asset_id', fetch, today)
+    return {row[0]: dict(zip(METRICS, row[1:])) for row in rows}
+
+
+def get_cache():
+  """Returns the metrics cache, creating it on first use."""
+  global _cache
+  with _cache_lock:
+    if _cache is None:
+      _cache = MetricsCache(METRICS_DB_PATH)
+    return _cache
@@ -19,13 +19,86 @@ action (REMOVE, ADD).
 This module ads or removes an asset from this ad
 """
 
-from googleads import adwords
+import copy
+import logging
+import threading
+import time
+from concurrent import futures
+from app.backend import structure
 from app.backend.service import Service_Class
 
 
 PAGE_SIZE = 500
+AD_CACHE_TTL = 15 * 60
+# max number of ad groups mutated in parallel
+MAX_WORKERS = 8
 actions = ['ADD', 'REMOVE']
 
+ASSET_TYPE_MAP = {
+    'TEXT': 'TextAsset',
+    'IMAGE': 'ImageAsset',
+    'YOUTUBE_VIDEO': 'YouTubeVideoAsset',
+    'MEDIA_BUNDLE': 'MediaBundleAsset'
+}
+AD_FIELDS = [
+    'Id',
+    'UniversalAppAdDescriptions',
+    'UniversalAppAdHeadlines',
+    'UniversalAppAdImages',
+    'UniversalAppAdYouTubeVideos',
+    'UniversalAppAdHtml5MediaBundles',
+]
+AD_PROPERTIES = [
+    'descriptions', 'headlines', 'images', 'videos', 'html5MediaBundles']
+
+
+class AdCache(object):
+  """Last known ad of every ad group, to skip the lookups before a mutation.
+
+  A SET replaces all of the ad's assets, so snapshots are only used once
+  change_status shows the ad didn't change since the snapshot was taken (see
+  mutate_ads). If a mutation based on a snapshot fails anyway, the snapshot is
+  dropped and the ad is fetched again. Snapshots expire after ttl seconds.
+  """
+
+  def __init__(self, ttl=AD_CACHE_TTL):
+    self._ttl = ttl
+    self._ads = {}
+    self._lock = threading.Lock()
+
+  def get(self, adgroup):
+    """Returns the time the ad group's ad was cached at and a copy of it.
+
+    Returns None if the ad isn't cached.
+    """
+    with self._lock:
+      cached = self._ads.get(adgroup)
+      if cached is None:
+        return None
+      if time.time() - cached[0] > self._ttl:
+        del self._ads[adgroup]
+        return None
+      return cached[0], copy.deepcopy(cached[1])
+
+  def put(self, adgroup, ad):
+    with self._lock:
+      self._ads[adgroup] = (time.time(), copy.deepcopy(ad))
+
+  def invalidate(self, adgroup):
+    with self._lock:
+      self._ads.pop(adgroup, None)
+
+  def clear(self):
+    with self._lock:
+      self._ads.clear()
+
+
+ad_cache = AdCache()
+# shared by all calls, so every worker keeps its copy of the client (and the
+# services built for it) across requests
+_executor = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+_worker_clients = threading.local()
+
 
 def mutate_ad(client,
               account,
@@ -38,35 +111,13 @@ def mutate_ad(client,
     raise ValueError('action not supported')
 
   client.SetClientCustomerId(account)
-
-  asset_type_map = {
-      'TEXT': 'TextAsset',
-      'IMAGE': 'ImageAsset',
-      'YOUTUBE_VIDEO': 'YouTubeVideoAsset',
-      'MEDIA_BUNDLE': 'MediaBundleAsset'
-  }
-  property_map = {
-      'TEXT': text_type_to_assign,
-      'IMAGE': 'images',
-      'YOUTUBE_VIDEO': 'videos',
-      'MEDIA_BUNDLE': 'html5MediaBundles'
-  }
-
-  asset_type = asset_type_map[asset['type']]
-  ad_property = property_map[asset['type']]
+  changes = [(asset, action, text_type_to_assign)]
 
   # ad id is required to add/remove assets from the adgroup
   ad_id = _get_ad_id(client, adgroup)
 
   selector = {
-      'fields': [
-          'Id',
-          'UniversalAppAdDescriptions',
-          'UniversalAppAdHeadlines',
-          'UniversalAppAdImages',
-          'UniversalAppAdYouTubeVideos',
-          'UniversalAppAdHtml5MediaBundles',
-      ],
+      'fields': AD_FIELDS,
       'predicates': [{
           'field': 'Id',
           'operator': 'EQUALS',
@@ -78,6 +129,217 @@ def mutate_ad(client,
 
   ad = ad_service.get(selector)['entries'][0]
 
+  _send_changes(client, adgroup, ad, changes)
+  Service_Class.reset_cid(client)
+
+
+def mutate_ads(client, mutations, googleads_client=None):
+  """Applies a batch of asset mutations with one read-modify-write per ad.
+
+  Ads are fetched once per account, except for the ad groups whose ad is in
+  ad_cache and, according to one change_status query per account, didn't
+  change since. All the changes to an ad are applied to it and sent in a
+  single SET. If the SET fails and holds more than one change, the changes are
+  retried one by one to find which ones failed.
+  Accounts and ad groups are processed in parallel by a shared pool of
+  MAX_WORKERS threads, each with its own copy of the client, so the given
+  client is left untouched.
+
+  Args:
+    client: adwords api client.
+    mutations: list of dicts with 'account', 'adgroup', 'asset', 'action' and
+      optionally 'text_type_to_assign'.
+    googleads_client: google ads api client, to check the cached ads with.
+      Without it, cached ads aren't used.
+  Returns:
+    list with None for every successful mutation, or the exception it failed
+    with, in the order of mutations.
+  """
+  results = [None] * len(mutations)
+  accounts = {}
+  for i, mutation in enumerate(mutations):
+    if mutation['action'] not in actions:
+      results[i] = ValueError('action not supported')
+      continue
+    accounts.setdefault(mutation['account'], {}).setdefault(
+        mutation['adgroup'], []).append(i)
+
+  snapshots = {}
+  if googleads_client is not None:
+    for adgroups in accounts.values():
+      for adgroup in adgroups:
+        snapshot = ad_cache.get(adgroup)
+        if snapshot is not None:
+          snapshots[adgroup] = snapshot
+
+  cached_ads = {}
+  fetched_ads = {}
+  lookups = [
+      _executor.submit(
+          _account_ads, client, googleads_client, account, list(adgroups),
+          {ag: snapshots[ag] for ag in adgroups if ag in snapshots})
+      for account, adgroups in accounts.items()
+  ]
+  for lookup in futures.as_completed(lookups):
+    cached, fetched = lookup.result()
+    cached_ads.update(cached)
+    fetched_ads.update(fetched)
+
+  tasks = {
+      _executor.submit(
+          _mutate_adgroup, client, account, adgroup,
+          cached_ads.get(adgroup), fetched_ads.get(adgroup),
+          _changes(mutations, indices)): indices
+      for account, adgroups in accounts.items()
+      for adgroup, indices in adgroups.items()
+  }
+  for task in futures.as_completed(tasks):
+    for i, error in zip(tasks[task], task.result()):
+      results[i] = error
+
+  return results
+
+
+def _account_ads(client, googleads_client, account, adgroups, snapshots):
+  """Returns the cached and the fetched ads of an account's ad groups.
+
+  A snapshot is used only if change_status shows no change to its ad since it
+  was taken, the ads of all other ad groups are fetched. Both are dicts of ad
+  group to its ad, fetched ads can also be the exception the lookup failed
+  with.
+  """
+  cached = {}
+  if snapshots:
+    try:
+      changed = structure.get_changed_ad_groups(
+          googleads_client, account,
+          {adgroup: taken for adgroup, (taken, _) in snapshots.items()})
+    except Exception as e:
+      logging.warning('could not check the cached ads of account %s: %s',
+                      account, e)
+      changed = set(snapshots)
+    for adgroup, (_, ad) in snapshots.items():
+      if adgroup in changed:
+        ad_cache.invalidate(adgroup)
+      else:
+        cached[adgroup] = ad
+
+  missing = [adgroup for adgroup in adgroups if adgroup not in cached]
+  if not missing:
+    return cached, {}
+  return cached, _fetch_ads(client, account, missing)
+
+
+def _worker_client(client):
+  """Returns the current thread's own copy of the client.
+
+  The copy has its own customer id, so workers can switch accounts without
+  affecting each other. Workers are long-lived, the copy is made once per
+  worker and client.
+  """
+  if getattr(_worker_clients, 'source', None) is not client:
+    _worker_clients.source = client
+    _worker_clients.client = copy.copy(client)
+  return _worker_clients.client
+
+
+def _fetch_ads(client, account, adgroups):
+  """Fetches the ads of an account's ad groups.
+
+  Returns a dict of ad group to its ad, or to the exception the lookup failed
+  with.
+  """
+  client = _worker_client(client)
+  client.SetClientCustomerId(account)
+  try:
+    ad_ids = _get_ad_ids(client, adgroups)
+    ads = _get_ads(client, list(ad_ids.values()))
+  except Exception as e:
+    return {adgroup: e for adgroup in adgroups}
+
+  return {
+      adgroup: ads.get(ad_ids.get(adgroup)) or
+               LookupError('no ad found in adgroup ' + str(adgroup))
+      for adgroup in adgroups
+  }
+
+
+def _mutate_adgroup(client, account, adgroup, cached_ad, fetched_ad, changes):
+  """Sends all the changes to an ad group's ad.
+
+  Returns a list with None for every successful change or its exception.
+  """
+  client = _worker_client(client)
+  client.SetClientCustomerId(account)
+
+  if cached_ad is not None:
+    try:
+      _send_changes(client, adgroup, cached_ad, changes)
+      return [None] * len(changes)
+    except Exception:
+      logging.info('cached ad of adgroup %s is outdated, refetching', adgroup)
+      ad_cache.invalidate(adgroup)
+      try:
+        fetched_ad = _get_ads(client, [_get_ad_id(client, adgroup)]).popitem()[1]
+      except Exception as e:
+        return [e] * len(changes)
+
+  if isinstance(fetched_ad, Exception):
+    return [fetched_ad] * len(changes)
+
+  try:
+    _send_changes(client, adgroup, fetched_ad, changes)
+    return [None] * len(changes)
+  except Exception as e:
+    if len(changes) == 1:
+      return [e]
+
+  errors = []
+  for asset, action, text_type_to_assign in changes:
+    try:
+      mutate_ad(client, account, adgroup, asset, action, text_type_to_assign)
+      errors.append(None)
+    except Exception as e:
+      errors.append(e)
+    client.SetClientCustomerId(account)
+  return errors
+
+
+def _changes(mutations, indices):
+  return [(mutations[i]['asset'], mutations[i]['action'],
+           mutations[i].get('text_type_to_assign', 'descriptions'))
+          for i in indices]
+
+
+def _send_changes(client, adgroup, ad, changes):
+  """Applies the changes to the ad, sends it and caches the updated ad."""
+  for asset, action, text_type_to_assign in changes:
+    _apply_change(ad, asset, action, text_type_to_assign)
+
+  ad_service = Service_Class.get_ad_service(client)
+  result = ad_service.mutate([{'operator': 'SET', 'operand': ad}])
+
+  # prefer the ad as returned by the API, if it holds all the asset lists
+  updated = ad
+  if result and result['value']:
+    returned = result['value'][0]
+    if all(returned[p] is not None for p in AD_PROPERTIES):
+      updated = returned
+  ad_cache.put(adgroup, updated)
+
+
+def _apply_change(ad, asset, action, text_type_to_assign):
+  """Adds or removes the asset in the ad's asset lists."""
+  property_map = {
+      'TEXT': text_type_to_assign,
+      'IMAGE': 'images',
+      'YOUTUBE_VIDEO': 'videos',
+      'MEDIA_BUNDLE': 'html5MediaBundles'
+  }
+
+  asset_type = ASSET_TYPE_MAP[asset['type']]
+  ad_property = property_map[asset['type']]
+
   # Case 1: adding an asset to the ad
   if action == 'ADD':
     attached_asset = [{
@@ -99,17 +361,8 @@ def mutate_ad(client,
 
   # Case 2: Removing an asset from the ad
   elif action == 'REMOVE':
-    for item in ad[ad_property]:
-      if item['asset']['assetId'] == asset['id']:
-        ad[ad_property].remove(item)
-
-  operations = [{
-      'operator': 'SET',
-      'operand': ad,
-  }]
-
-  ad_service.mutate(operations)
-  Service_Class.reset_cid(client)
+    ad[ad_property] = [item for item in ad[ad_property]
+                       if item['asset']['assetId'] != asset['id']]
 
 
 def _get_ad_id(client, adgroup):
@@ -128,3 +381,50 @@ def _get_ad_id(client, adgroup):
   return page['entries'][0]['ad']['id']
 
 
+def _get_ad_ids(client, adgroups):
+  """gets the ad ids of the given adgroups, as adgroup to ad id dict."""
+  adgroupad_service = Service_Class.get_ad_group_ad_service(client)
+  selector = {
+      'fields': ['Id', 'AdGroupId'],
+      'predicates': [{
+          'field': 'AdGroupId',
+          'operator': 'IN',
+          'values': adgroups
+      }],
+  }
+
+  ad_ids = {}
+  for entry in _get_all_entries(adgroupad_service, selector):
+    ad_ids.setdefault(entry['adGroupId'], entry['ad']['id'])
+  return ad_ids
+
+
+def _get_ads(client, ad_ids):
+  """gets the ads with all of their assets, as ad id to ad dict."""
+  if not ad_ids:
+    return {}
+  ad_service = Service_Class.get_ad_service(client)
+  selector = {
+      'fields': AD_FIELDS,
+      'predicates': [{
+          'field': 'Id',
+          'operator': 'IN',
+          'values': ad_ids,
+      }],
+  }
+  return {ad['id']: ad for ad in _get_all_entries(ad_service, selector)}
+
+
+def _get_all_entries(service, selector):
+  """Pages through the results of a get call."""
+  offset = 0
+  selector['paging'] = {'startIndex': offset, 'numberResults': PAGE_SIZE}
+  while True:
+    page = service.get(selector)
+    entries = page['entries'] if 'entries' in page else []
+    for entry in entries:
+      yield entry
+    offset += PAGE_SIZE
+    if offset >= page['totalNumEntries']:
+      break
+    selector['paging']['startIndex'] = offset
@@ -0,0 +1,175 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adaptive rate limiting of the Google Ads API requests.
+
+All report requests share one limiter. Requests are paced by a token bucket
+and the number of requests in flight is adapted AIMD-style: it grows by one
+for every limit's worth of successful requests and is halved whenever the API
+throttles us, in which case new requests also wait for the delay the API asked
+for.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+
+MAX_QPS = float(os.environ.get('ASSETMG_MAX_QPS', 20))
+MAX_CONCURRENCY = 32
+MIN_CONCURRENCY = 1
+INITIAL_CONCURRENCY = 8
+# wait used when a throttling error doesn't say how long to wait
+DEFAULT_RETRY_DELAY = 5
+MAX_RETRIES = 5
+
+_RETRY_IN = re.compile(r'[Rr]etry in (\d+) seconds')
+
+
+class RateLimiter(object):
+  """Token bucket with an AIMD concurrency limit and retry-after pauses."""
+
+  def __init__(self, rate=MAX_QPS, concurrency=INITIAL_CONCURRENCY,
+               min_concurrency=MIN_CONCURRENCY,
+               max_concurrency=MAX_CONCURRENCY, clock=time.monotonic):
+    self._rate = rate
+    self._tokens = rate
+    self._limit = float(concurrency)
+    self._min_concurrency = min_concurrency
+    self._max_concurrency = max_concurrency
+    self._in_flight = 0
+    self._paused_until = 0
+    self._decreased_at = None
+    self._clock = clock
+    self._updated = clock()
+    self._cond = threading.Condition()
+
+  @property
+  def concurrency(self):
+    return int(self._limit)
+
+  def _refill(self, now):
+    self._tokens = min(
+        self._rate, self._tokens + (now - self._updated) * self._rate)
+    self._updated = now
+
+  def acquire(self):
+    """Blocks until a request can be sent, returns the time it was sent."""
+    with self._cond:
+      while True:
+        now = self._clock()
+        self._refill(now)
+        if now < self._paused_until:
+          wait = self._paused_until - now
+        elif self._in_flight >= int(self._limit):
+          wait = None
+        elif self._tokens < 1:
+          wait = (1 - self._tokens) / self._rate
+        else:
+          self._tokens -= 1
+          self._in_flight += 1
+          return now
+        self._cond.wait(wait)
+
+  def release(self, sent=None, throttled=False, retry_after=None):
+    """Records the outcome of a request sent after acquire().
+
+    Args:
+      sent: the time returned by acquire().
+      throttled: whether the API rejected the request for exceeding quota.
+      retry_after: seconds the API asked to wait before retrying, if any.
+    """
+    with self._cond:
+      self._in_flight -= 1
+      if throttled:
+        # requests sent before the last decrease don't decrease it again
+        if (sent is None or self._decreased_at is None
+            or sent >= self._decreased_at):
+          self._limit = max(self._min_concurrency, self._limit / 2)
+          self._decreased_at = self._clock()
+        delay = DEFAULT_RETRY_DELAY if retry_after is None else retry_after
+        self._paused_until = max(self._paused_until, self._clock() + delay)
+        logging.warning('Throttled by the API, waiting %ss, concurrency %d',
+                        delay, self._limit)
+      else:
+        self._limit = min(
+            self._max_concurrency, self._limit + 1 / int(self._limit))
+      self._cond.notify_all()
+
+  def stream(self, fn):
+    """Opens a stream under the limiter, retrying it when throttled.
+
+    fn(release) opens the stream and hands it release, which the stream calls
+    with None, or the exception it failed with, once it ends, fails or is
+    closed. The stream holds its slot in the limiter until then. If fn raises,
+    the request is over and, if it was throttled, retried.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+      release = self._stream_release(self.acquire())
+      try:
+        return fn(release)
+      except Exception as e:
+        release(e)
+        if throttle_delay(e) is False or attempt == MAX_RETRIES:
+          raise
+
+  def _stream_release(self, sent):
+    """Returns a function releasing a stream's slot, once."""
+    released = threading.Lock()
+
+    def release(error=None):
+      if not released.acquire(blocking=False):
+        return
+      retry_after = False if error is None else throttle_delay(error)
+      throttled = retry_after is not False
+      self.release(sent, throttled, retry_after if throttled else None)
+    return release
+
+
+def throttle_delay(error):
+  """Checks whether error is a quota error.
+
+  Returns:
+    False if it isn't one, otherwise the seconds the API asked to wait, or
+    None if it didn't say.
+  """
+  call = getattr(error, 'error', error)  # GoogleAdsException wraps the call
+  code = getattr(call, 'code', None)
+  if callable(code):
+    try:
+      code = code()
+    except Exception:
+      code = None
+  throttled = getattr(code, 'name', None) == 'RESOURCE_EXHAUSTED'
+
+  failure = getattr(error, 'failure', None)
+  for ads_error in getattr(failure, 'errors', ()):
+    error_code = getattr(ads_error, 'error_code', None)
+    if getattr(error_code, 'quota_error', 0):
+      throttled = True
+    details = getattr(getattr(ads_error, 'details', None),
+                      'quota_error_details', None)
+    retry_delay = getattr(details, 'retry_delay', None)
+    if getattr(retry_delay, 'seconds', 0):
+      return retry_delay.seconds
+
+  if not throttled:
+    return False
+  match = _RETRY_IN.search(str(error))
+  return int(match.group(1)) if match else None
+
+
+limiter = RateLimiter()
@@ -0,0 +1,226 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact in-memory model of the account structure.
+
+The structure builders produce these records instead of nested dicts. Every
+asset-ad group row is a small slotted record that refers to a single shared
+Asset record, and enum names are interned, so large MCCs fit in a fraction of
+the memory. Records are converted to the JSON dicts of the cache files and the
+API with to_json(), and read back with from_json().
+"""
+
+import sys
+
+
+def intern(value):
+  return sys.intern(value) if isinstance(value, str) else value
+
+
+def performance_type(asset_type, text_type):
+  """Returns the performance type an asset is keyed by in asset_to_ag.json."""
+  return text_type if asset_type == 'TEXT' else 'nontext'
+
+
+class Asset(object):
+  """An asset, shared by all the ad groups it is assigned to."""
+
+  __slots__ = ['id', 'name', 'type', 'text_type', 'asset_text', 'image_url',
+               'file_size', 'image_height', 'image_width', 'video_id']
+
+  def __init__(self, asset_id, name, asset_type, text_type=None,
+               asset_text=None, image_url=None, file_size=None,
+               image_height=None, image_width=None, video_id=None):
+    self.id = asset_id
+    self.name = name
+    self.type = intern(asset_type)
+    self.text_type = intern(text_type)
+    self.asset_text = asset_text
+    self.image_url = image_url
+    self.file_size = file_size
+    self.image_height = image_height
+    self.image_width = image_width
+    self.video_id = video_id
+
+  @property
+  def key(self):
+    """(id, performance type), the key of the asset in asset_to_ag.json."""
+    return self.id, performance_type(self.type, self.text_type)
+
+  def update_json(self, data):
+    """Adds the type specific fields to an asset's JSON dict."""
+    if self.type == 'IMAGE':
+      data['image_url'] = self.image_url
+      data['file_size'] = self.file_size
+      data['image_height'] = self.image_height
+      data['image_width'] = self.image_width
+    elif self.type == 'TEXT':
+      data['text_type'] = self.text_type
+      data['asset_text'] = self.asset_text
+    elif self.type == 'YOUTUBE_VIDEO':
+      data['video_id'] = self.video_id
+      data['link'] = f'https://www.youtube.com/watch?v={self.video_id}'
+      data['image_url'] = f'https://img.youtube.com/vi/{self.video_id}/1.jpg'
+    return data
+
+  @classmethod
+  def from_json(cls, data):
+    return cls(data['id'], data.get('name'), data['type'],
+               text_type=data.get('text_type'),
+               asset_text=data.get('asset_text'),
+               image_url=data.get('image_url'),
+               file_size=data.get('file_size'),
+               image_height=data.get('image_height'),
+               image_width=data.get('image_width'),
+               video_id=data.get('video_id'))
+
+
+class AdGroupAsset(object):
+  """An asset in an ad group, with its performance and metrics there."""
+
+  __slots__ = ['asset', 'performance', 'clicks', 'all_conversions',
+               'impressions', 'cost']
+
+  def __init__(self, asset, performance, clicks=0, all_conversions=0,
+               impressions=0, cost=0):
+    self.asset = asset
+    self.performance = intern(performance)
+    self.clicks = clicks
+    self.all_conversions = all_conversions
+    self.impressions = impressions
+    self.cost = cost
+
+  def to_json(self):
+    return self.asset.update_json({
+        'id': self.asset.id,
+        'name': self.asset.name,
+        'type': self.asset.type,
+        'stats': {
+            'clicks': self.clicks,
+            'all_conversions': self.all_conversions,
+            'impressions': self.impressions,
+            'cost': self.cost,
+        },
+        'performance': self.performance,
+    })
+
+  @classmethod
+  def from_json(cls, data, assets=None):
+    """Reads an asset JSON dict, sharing Asset records through assets."""
+    asset = Asset.from_json(data)
+    if assets is not None:
+      asset = assets.setdefault(asset.key, asset)
+    stats = data.get('stats', {})
+    return cls(asset, data.get('performance'), stats.get('clicks', 0),
+               stats.get('all_conversions', 0), stats.get('impressions', 0),
+               stats.get('cost', 0))
+
+
+class AdGroup(object):
+
+  __slots__ = ['id', 'name', 'status', 'assets']
+
+  def __init__(self, ad_group_id, name, status, assets=None):
+    self.id = ad_group_id
+    self.name = name
+    self.status = intern(status)
+    self.assets = assets if assets is not None else []
+
+  def to_json(self):
+    return {
+        'id': self.id,
+        'name': self.name,
+        'status': self.status,
+        'assets': [asset.to_json() for asset in self.assets],
+    }
+
+  @classmethod
+  def from_json(cls, data, assets=None):
+    return cls(data['id'], data['name'], data['status'],
+               [AdGroupAsset.from_json(asset, assets)
+                for asset in data['assets']])
+
+
+class Campaign(object):
+
+  __slots__ = ['id', 'name', 'status', 'ad_groups']
+
+  def __init__(self, campaign_id, name, status, ad_groups=None):
+    self.id = campaign_id
+    self.name = name
+    self.status = intern(status)
+    self.ad_groups = ad_groups if ad_groups is not None else []
+
+  def to_json(self):
+    return {
+        'id': self.id,
+        'campaign_name': self.name,
+        'status': self.status,
+        'adgroups': [ad_group.to_json() for ad_group in self.ad_groups],
+    }
+
+  @classmethod
+  def from_json(cls, data, assets=None):
+    return cls(data['id'], data['campaign_name'], data['status'],
+               [AdGroup.from_json(ad_group, assets)
+                for ad_group in data['adgroups']])
+
+
+class Account(object):
+
+  __slots__ = ['id', 'name', 'campaigns']
+
+  def __init__(self, account_id, name, campaigns=None):
+    self.id = account_id
+    self.name = name
+    self.campaigns = campaigns if campaigns is not None else []
+
+  def to_json(self):
+    return {
+        'id': self.id,
+        'name': self.name,
+        'campaigns': [campaign.to_json() for campaign in self.campaigns],
+    }
+
+  @classmethod
+  def from_json(cls, data):
+    assets = {}
+    return cls(data['id'], data['name'],
+               [Campaign.from_json(campaign, assets)
+                for campaign in data['campaigns']])
+
+
+class AssetEntry(object):
+  """An asset_to_ag.json entry: an asset and the ad groups it is in.
+
+  As in the JSON entries, the asset fields (including stats and performance)
+  are those of the first ad group the asset was found in.
+  """
+
+  __slots__ = ['first', 'links']
+
+  def __init__(self, first):
+    self.first = first
+    # (ad group id, performance)
+    self.links = []
+
+  def to_json(self):
+    performance_type = self.first.asset.key[1]
+    data = self.first.to_json()
+    data['adgroups'] = [
+        {'id': ad_group_id, 'performance': performance,
+         'performance_type': performance_type}
+        for ad_group_id, performance in self.links
+    ]
+    return data
@@ -0,0 +1,76 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of serialized responses for the cache-backed read routes.
+
+Responses are kept serialized and gzipped, together with a strong ETag, for as
+long as the version of the data they were built from doesn't change.
+"""
+
+import collections
+import gzip
+import hashlib
+import threading
+
+
+MAX_ENTRIES = 64
+
+CachedResponse = collections.namedtuple(
+    'CachedResponse', ['body', 'gzip_body', 'etag'])
+
+
+class ResponseCache(object):
+  """LRU cache of serialized responses, keyed by request and data version."""
+
+  def __init__(self, max_entries=MAX_ENTRIES):
+    self._max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, version, build):
+    """Returns the cached response of key, building it if it is outdated.
+
+    Args:
+      key: hashable identifying the request.
+      version: version of the data the response is built from.
+      build: function returning the serialized body (str), or None if there
+        is nothing to serve. None is not cached.
+    Returns:
+      CachedResponse, or None if build returned None.
+    """
+    with self._lock:
+      cached = self._entries.get(key)
+      if cached and cached[0] == version:
+        self._entries.move_to_end(key)
+        return cached[1]
+
+    body = build()
+    if body is None:
+      return None
+    body = body.encode('utf-8')
+    response = CachedResponse(
+        body=body,
+        gzip_body=gzip.compress(body, compresslevel=6),
+        etag=hashlib.sha1(body).hexdigest())
+
+    with self._lock:
+      self._entries[key] = (version, response)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+    return response
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
@@ -0,0 +1,210 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serialization formats of the list cache files.
+
+Set ASSETMG_CACHE_FORMAT to pick the format new cache files are written in:
+
+  json          the original, indented JSON list (default).
+  msgpack       length-prefixed msgpack records, one per list item.
+  msgpack-zlib  the same, with every record zlib compressed.
+
+Binary files start with a header naming their format, so readers detect the
+format of every file and files in any format can be read, whatever the
+configured one. The msgpack formats need the msgpack package.
+"""
+
+import json
+import logging
+import os
+import struct
+import zlib
+
+
+_MAGIC = b'AMGC'
+_LENGTH = struct.Struct('>I')
+
+
+class JsonFormat(object):
+  """A JSON list, with every item indented."""
+
+  name = 'json'
+
+  def list_writer(self, f):
+    return _JsonListWriter(f)
+
+  def loads_item(self, data):
+    return json.loads(data)
+
+  def load(self, f):
+    return json.load(f)
+
+  def iter_load(self, f):
+    # the json module can't parse a list incrementally
+    yield from json.load(f)
+
+
+class _JsonListWriter(object):
+
+  def __init__(self, f):
+    self._f = f
+    self._count = 0
+    f.write(b'[\n')
+
+  def add(self, item):
+    """Writes an item, returns the (offset, length) of its data."""
+    if self._count:
+      self._f.write(b',\n')
+    self._count += 1
+    data = json.dumps(item, indent=2).encode('utf-8')
+    offset = self._f.tell()
+    self._f.write(data)
+    return offset, len(data)
+
+  def close(self):
+    self._f.write(b'\n]')
+
+
+class MsgpackFormat(object):
+  """Length-prefixed msgpack records, optionally zlib compressed."""
+
+  def __init__(self, name, code, compress):
+    self.name = name
+    self.code = code
+    self._compress = compress
+
+  def list_writer(self, f):
+    return _RecordListWriter(f, self)
+
+  def dumps_item(self, item):
+    import msgpack
+    data = msgpack.packb(item, use_bin_type=True)
+    # fast compression, the files are read far more often than written
+    return zlib.compress(data, 1) if self._compress else data
+
+  def loads_item(self, data):
+    import msgpack
+    if self._compress:
+      data = zlib.decompress(data)
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+  def load(self, f):
+    return list(self.iter_load(f))
+
+  def iter_load(self, f):
+    while True:
+      prefix = f.read(_LENGTH.size)
+      if not prefix:
+        return
+      if len(prefix) < _LENGTH.size:
+        raise ValueError('truncated %s file' % self.name)
+      length, = _LENGTH.unpack(prefix)
+      data = f.read(length)
+      if len(data) < length:
+        raise ValueError('truncated %s file' % self.name)
+      yield self.loads_item(data)
+
+
+class _RecordListWriter(object):
+
+  def __init__(self, f, file_format):
+    self._f = f
+    self._format = file_format
+    f.write(_MAGIC + file_format.code)
+
+  def add(self, item):
+    """Writes an item, returns the (offset, length) of its data."""
+    data = self._format.dumps_item(item)
+    self._f.write(_LENGTH.pack(len(data)))
+    offset = self._f.tell()
+    self._f.write(data)
+    return offset, len(data)
+
+  def close(self):
+    pass
+
+
+FORMATS = {
+    'json': JsonFormat(),
+    'msgpack': MsgpackFormat('msgpack', b'm', compress=False),
+    'msgpack-zlib': MsgpackFormat('msgpack-zlib', b'z', compress=True),
+}
+_BY_CODE = {f.code: f for f in FORMATS.values() if hasattr(f, 'code')}
+
+
+def get_format(name=None):
+  """Returns the format called name, by default the configured one.
+
+  Falls back to JSON, with a warning, if the format is unknown or msgpack is
+  not installed.
+  """
+  if name is None:
+    name = os.environ.get('ASSETMG_CACHE_FORMAT', 'json')
+  file_format = FORMATS.get(name)
+  if file_format is None:
+    logging.warning('Unknown cache format %s, using json', name)
+    return FORMATS['json']
+  if isinstance(file_format, MsgpackFormat):
+    try:
+      import msgpack  # pylint: disable=unused-import
+    except ImportError:
+      logging.warning('msgpack is not installed, using json cache files')
+      return FORMATS['json']
+  return file_format
+
+
+def detect(f):
+  """Returns the format of the binary file f, positioned after its header."""
+  header = f.read(len(_MAGIC) + 1)
+  if len(header) == len(_MAGIC) + 1 and header.startswith(_MAGIC):
+    file_format = _BY_CODE.get(header[-1:])
+    if file_format is None:
+      raise ValueError('unknown cache file format %r' % header)
+    return file_format
+  f.seek(0)
+  return FORMATS['json']
+
+
+def load(path):
+  """Returns the list in the cache file at path, in any format."""
+  with open(path, 'rb') as f:
+    return detect(f).load(f)
+
+
+def iter_load(path):
+  """Returns an iterator over the list in the cache file at path.
+
+  msgpack files are read one item at a time, JSON files are parsed at once.
+
+  Raises:
+    FileNotFoundError: if there is no such file.
+  """
+  f = open(path, 'rb')
+  try:
+    file_format = detect(f)
+  except BaseException:
+    f.close()
+    raise
+  return _iter_items(f, file_format)
+
+
+def _iter_items(f, file_format):
+  with f:
+    yield from file_format.iter_load(f)
+
+
+def file_format(path):
+  """Returns the format of the cache file at path."""
+  with open(path, 'rb') as f:
+    return detect(f)
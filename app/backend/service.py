@@ -12,40 +12,83 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import threading
 import yaml
 
 VERSION = 'v201809'
+CONFIG_FILE_PATH = 'app/config/googleads.yaml'
 
 class Service_Class:
+  """Registry of AdWords services.
+
+  Services are built once per (client, service, version), as building one
+  processes the service's WSDL. A service reads its client's customer id when
+  it is called, so it serves every account. googleads.yaml is parsed once and
+  parsed again only when the file changes.
+  """
+
+  # (client, services) by id of the client. Clients are long-lived: the app's
+  # client and the copies of the mutate workers. clear() drops them once the
+  # clients are replaced.
+  _services = {}
+  _lock = threading.Lock()
+  _config_mtime = None
+  _default_cid = None
+
+  @classmethod
+  def get_service(cls, client, name, version=VERSION):
+    with cls._lock:
+      entry = cls._services.get(id(client))
+      if entry is None or entry[0] is not client:
+        entry = cls._services[id(client)] = (client, {})
+      services = entry[1]
+      if (name, version) not in services:
+        services[name, version] = client.GetService(name, version=version)
+      return services[name, version]
+
+  @classmethod
+  def clear(cls):
+    """Drops the services of all clients, for when the clients are rebuilt."""
+    with cls._lock:
+      cls._services.clear()
 
   @staticmethod
   def get_ad_service(client):
-    return client.GetService('AdService', version=VERSION)
+    return Service_Class.get_service(client, 'AdService')
 
   @staticmethod
   def get_campaign_service(client):
-    return client.GetService('CampaignService', version=VERSION)
+    return Service_Class.get_service(client, 'CampaignService')
 
   @staticmethod
   def get_managed_customer_service(client):
-    return client.GetService('ManagedCustomerService', version=VERSION)
+    return Service_Class.get_service(client, 'ManagedCustomerService')
 
   @staticmethod
   def get_ad_group_service(client):
-    return client.GetService('AdGroupService', version=VERSION)
+    return Service_Class.get_service(client, 'AdGroupService')
 
   @staticmethod
   def get_ad_group_ad_service(client):
-    return client.GetService('AdGroupAdService', version=VERSION)
+    return Service_Class.get_service(client, 'AdGroupAdService')
 
   @staticmethod
   def get_asset_service(client):
-    return client.GetService('AssetService', version=VERSION)
+    return Service_Class.get_service(client, 'AssetService')
+
+  @classmethod
+  def get_default_cid(cls):
+    """Returns the customer id in googleads.yaml."""
+    mtime = os.stat(CONFIG_FILE_PATH).st_mtime_ns
+    with cls._lock:
+      if mtime != cls._config_mtime:
+        with open(CONFIG_FILE_PATH, 'r') as f:
+          config = yaml.load(f, Loader=yaml.FullLoader)
+        cls._default_cid = config['adwords']['client_customer_id']
+        cls._config_mtime = mtime
+      return cls._default_cid
 
   @staticmethod
   def reset_cid(client):
-    with open('app/config/googleads.yaml', 'r') as f:
-      config = yaml.load(f, Loader=yaml.FullLoader)
-    
-    cid = config['adwords']['client_customer_id']
-    client.SetClientCustomerId(cid)
+    client.SetClientCustomerId(Service_Class.get_default_cid())
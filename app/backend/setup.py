@@ -23,8 +23,6 @@ import json
 import os
 from pathlib import Path
 import logging
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleads import adwords
 
 LOGS_PATH = Path('app/logs/server.log')
 logging.basicConfig(filename=LOGS_PATH ,level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
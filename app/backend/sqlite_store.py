@@ -0,0 +1,496 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""SQLite backed store for the account structure and asset mappings.
+
+Drop-in replacement for asset_store.AssetStore. The structure built into
+account_struct.json and asset_to_ag.json is imported once per build, after
+that every asset change is a transaction touching only that asset's rows. The
+assets are written back to asset_to_ag.json before every refresh, which builds
+on the file.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from app.backend import cache_files
+from app.backend.asset_store import DEFAULT_PAGE_SIZE, performance_type
+
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS meta (
+      key TEXT PRIMARY KEY,
+      value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS accounts (
+      id INTEGER PRIMARY KEY,
+      name TEXT,
+      position INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS campaigns (
+      id INTEGER PRIMARY KEY,
+      account_id INTEGER,
+      data TEXT,
+      position INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS campaigns_account ON campaigns(account_id);
+    CREATE TABLE IF NOT EXISTS ad_groups (
+      id INTEGER PRIMARY KEY,
+      campaign_id INTEGER,
+      account_id INTEGER,
+      data TEXT,
+      position INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS ad_groups_campaign ON ad_groups(campaign_id);
+    CREATE INDEX IF NOT EXISTS ad_groups_account ON ad_groups(account_id);
+    CREATE TABLE IF NOT EXISTS assets (
+      id INTEGER,
+      performance_type TEXT,
+      position INTEGER UNIQUE,
+      data TEXT,
+      PRIMARY KEY (id, performance_type)
+    );
+    CREATE TABLE IF NOT EXISTS asset_ad_groups (
+      asset_id INTEGER,
+      performance_type TEXT,
+      ad_group_id INTEGER,
+      link TEXT,
+      PRIMARY KEY (asset_id, performance_type, ad_group_id)
+    );
+    CREATE INDEX IF NOT EXISTS asset_ad_groups_ad_group
+      ON asset_ad_groups(ad_group_id);
+    CREATE TABLE IF NOT EXISTS journal (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      record TEXT
+    );
+'''
+
+_SORT_COLUMNS = {
+    'index': 'a.position',
+    'id': 'a.id',
+    'name': "COALESCE(json_extract(a.data, '$.name'), '')",
+    'type': "COALESCE(json_extract(a.data, '$.type'), '')",
+}
+
+
+class SqliteStore(object):
+  """Account structure and asset to ad groups entries in a SQLite database."""
+
+  def __init__(self, db_file, assets_file, structure_file):
+    self._db_file = db_file
+    self._assets_file = assets_file
+    self._structure_file = structure_file
+    self._local = threading.local()
+    # serializes writers, so positions are assigned consistently
+    self._write_lock = threading.Lock()
+    self._version = 0
+    self._refreshing = False
+    self._conn().executescript(_SCHEMA)
+    self.reload()
+
+  def _conn(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(str(self._db_file), timeout=30)
+      conn.execute('PRAGMA journal_mode=WAL')
+      self._local.conn = conn
+    return conn
+
+  def _source_version(self):
+    versions = []
+    for path in (self._structure_file, self._assets_file,
+                 cache_files.journal_path(self._assets_file)):
+      try:
+        versions.append(str(os.stat(path).st_mtime_ns))
+      except FileNotFoundError:
+        versions.append('')
+    return ':'.join(versions)
+
+  def reload(self):
+    """Imports the cache files, if they changed since the last import."""
+    with self._write_lock:
+      self._reload(self._conn())
+
+  def _reload(self, conn):
+    """Imports the cache files, called with the write lock held.
+
+    Changes journaled during a refresh are applied on top of the imported
+    files, along with the journal of asset_to_ag.json left by the JSON store.
+    """
+    with conn:
+      journal = [json.loads(record) for (record,) in conn.execute(
+          'SELECT record FROM journal ORDER BY seq')]
+      conn.execute('DELETE FROM journal')
+      version = self._source_version()
+      row = conn.execute(
+          'SELECT value FROM meta WHERE key = ?',
+          ('source_version',)).fetchone()
+      if row and row[0] == version:
+        # the journaled changes are in the database already
+        return
+
+      try:
+        structure = cache_files.read_structure(self._structure_file)
+      except (FileNotFoundError, ValueError):
+        structure = []
+      try:
+        entries = cache_files.read_list(self._assets_file)
+      except (FileNotFoundError, ValueError):
+        entries = []
+
+      for table in ('accounts', 'campaigns', 'ad_groups', 'assets',
+                    'asset_ad_groups'):
+        conn.execute(f'DELETE FROM {table}')
+      for position, account in enumerate(structure):
+        self._insert_account(conn, account, position)
+      for position, entry in enumerate(entries):
+        self._insert_entry(conn, entry, position)
+      for record in cache_files.read_journal(self._assets_file) + journal:
+        self._apply(conn, record)
+      conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                   ('source_version', version))
+      self._version += 1
+    logging.info('Imported structure to %s', self._db_file)
+
+  @contextlib.contextmanager
+  def refreshing(self):
+    """Wraps a refresh that rebuilds the cache files.
+
+    See asset_store.AssetStore.refreshing. Changes made during the refresh are
+    journaled in the database, and applied on top of the refreshed files when
+    they are imported.
+    """
+    conn = self._conn()
+    with self._write_lock:
+      self._flush(conn)
+      self._refreshing = True
+    try:
+      yield
+    finally:
+      with self._write_lock:
+        self._refreshing = False
+        self._reload(conn)
+
+  def _apply(self, conn, record):
+    """Applies a journal record."""
+    if record['op'] == 'put':
+      self._put(conn, record['entry'], None)
+    elif record['op'] == 'add_links':
+      self._add_links(conn, record['entry'], record['links'])
+    elif record['op'] == 'remove_links':
+      self._remove_links(conn, record['id'], record['performance_type'],
+                         record['ad_group_ids'])
+    else:
+      raise ValueError('unknown journal record: ' + record['op'])
+
+  def _journal(self, conn, record):
+    if self._refreshing:
+      conn.execute('INSERT INTO journal (record) VALUES (?)',
+                   (json.dumps(record),))
+
+  def _insert_account(self, conn, account, position):
+    conn.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)',
+                 (account['id'], account['name'], position))
+    for campaign_position, campaign in enumerate(account['campaigns']):
+      campaign_data = {k: v for k, v in campaign.items() if k != 'adgroups'}
+      conn.execute(
+          'INSERT OR REPLACE INTO campaigns VALUES (?, ?, ?, ?)',
+          (campaign['id'], account['id'], json.dumps(campaign_data),
+           campaign_position))
+      conn.executemany(
+          'INSERT OR REPLACE INTO ad_groups VALUES (?, ?, ?, ?, ?)',
+          [(ad_group['id'], campaign['id'], account['id'],
+            json.dumps(ad_group), ad_group_position)
+           for ad_group_position, ad_group in enumerate(campaign['adgroups'])])
+
+  def _insert_entry(self, conn, entry, position):
+    key = (entry['id'], performance_type(entry))
+    data = {k: v for k, v in entry.items() if k != 'adgroups'}
+    conn.execute('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?)',
+                 key + (position, json.dumps(data)))
+    conn.executemany(
+        'INSERT OR REPLACE INTO asset_ad_groups VALUES (?, ?, ?, ?)',
+        [key + (ad_group['id'], json.dumps(ad_group))
+         for ad_group in entry['adgroups']])
+
+  def _entry(self, conn, asset_id, perf_type, data):
+    entry = json.loads(data)
+    entry['adgroups'] = [
+        json.loads(link) for (link,) in conn.execute(
+            'SELECT link FROM asset_ad_groups '
+            'WHERE asset_id = ? AND performance_type = ? ORDER BY rowid',
+            (asset_id, perf_type))
+    ]
+    return entry
+
+  def _entries(self, query, args=()):
+    conn = self._conn()
+    return [self._entry(conn, asset_id, perf_type, data)
+            for asset_id, perf_type, data in conn.execute(query, args)]
+
+  def get(self, asset_id, perf_type):
+    """Returns the (index, entry) of an asset, or (None, None)."""
+    conn = self._conn()
+    row = conn.execute(
+        'SELECT position, data FROM assets '
+        'WHERE id = ? AND performance_type = ?',
+        (asset_id, perf_type)).fetchone()
+    if not row:
+      return None, None
+    return row[0], self._entry(conn, asset_id, perf_type, row[1])
+
+  def find(self, asset_id):
+    """Returns the (index, entry) of every performance type of an asset."""
+    conn = self._conn()
+    return [(position, self._entry(conn, asset_id, perf_type, data))
+            for position, perf_type, data in conn.execute(
+                'SELECT position, performance_type, data FROM assets '
+                'WHERE id = ? ORDER BY position', (asset_id,))]
+
+  def _position(self, conn, key):
+    """Returns the position of an asset, or the next free one."""
+    row = conn.execute(
+        'SELECT position FROM assets WHERE id = ? AND performance_type = ?',
+        key).fetchone()
+    if row:
+      return row[0]
+    return conn.execute(
+        'SELECT COALESCE(MAX(position) + 1, 0) FROM assets').fetchone()[0]
+
+  def put(self, entry, index=None):
+    """Adds or replaces an entry in a single transaction, returns its index."""
+    conn = self._conn()
+    with self._write_lock, conn:
+      index = self._put(conn, entry, index)
+      self._journal(conn, {'op': 'put', 'entry': entry})
+      self._version += 1
+    return index
+
+  def _put(self, conn, entry, index):
+    key = (entry['id'], performance_type(entry))
+    if index is None:
+      index = self._position(conn, key)
+    old = conn.execute(
+        'SELECT id, performance_type FROM assets WHERE position = ?',
+        (index,)).fetchone()
+    for old_key in {key, old} - {None}:
+      conn.execute(
+          'DELETE FROM assets WHERE id = ? AND performance_type = ?', old_key)
+      conn.execute(
+          'DELETE FROM asset_ad_groups '
+          'WHERE asset_id = ? AND performance_type = ?', old_key)
+    self._insert_entry(conn, entry, index)
+    return index
+
+  def add_links(self, entry, links):
+    """Links an asset to ad groups in a single transaction.
+
+    See asset_store.AssetStore.add_links.
+    """
+    entry = dict(entry, adgroups=[])
+    conn = self._conn()
+    with self._write_lock, conn:
+      index = self._add_links(conn, entry, links)
+      self._journal(conn, {'op': 'add_links', 'entry': entry, 'links': links})
+      self._version += 1
+      return index, self.get(entry['id'], performance_type(entry))[1]
+
+  def _add_links(self, conn, entry, links):
+    key = (entry['id'], performance_type(entry))
+    exists = conn.execute(
+        'SELECT 1 FROM assets WHERE id = ? AND performance_type = ?',
+        key).fetchone()
+    index = self._position(conn, key)
+    if not exists:
+      self._insert_entry(conn, entry, index)
+    conn.executemany(
+        'INSERT OR IGNORE INTO asset_ad_groups VALUES (?, ?, ?, ?)',
+        [key + (link['id'], json.dumps(link)) for link in links])
+    return index
+
+  def remove_links(self, asset_id, perf_type, ad_group_ids):
+    """Unlinks an asset from ad groups in a single transaction.
+
+    See asset_store.AssetStore.remove_links.
+    """
+    conn = self._conn()
+    with self._write_lock, conn:
+      self._remove_links(conn, asset_id, perf_type, ad_group_ids)
+      self._journal(conn, {
+          'op': 'remove_links', 'id': asset_id, 'performance_type': perf_type,
+          'ad_group_ids': list(ad_group_ids)})
+      self._version += 1
+      return self.get(asset_id, perf_type)
+
+  def _remove_links(self, conn, asset_id, perf_type, ad_group_ids):
+    conn.executemany(
+        'DELETE FROM asset_ad_groups '
+        'WHERE asset_id = ? AND performance_type = ? AND ad_group_id = ?',
+        [(asset_id, perf_type, ad_group_id) for ad_group_id in ad_group_ids])
+
+  def assign_account(self, ad_group_id, account_id):
+    """Records the account of an ad group that isn't in the structure yet."""
+    conn = self._conn()
+    with self._write_lock, conn:
+      conn.execute(
+          'INSERT OR IGNORE INTO ad_groups (id, account_id) VALUES (?, ?)',
+          (ad_group_id, account_id))
+
+  def by_ad_group(self, ad_group_id):
+    """Returns the entries of all assets assigned to the ad group."""
+    return self._entries(
+        'SELECT a.id, a.performance_type, a.data FROM assets a '
+        'JOIN asset_ad_groups l '
+        'ON l.asset_id = a.id AND l.performance_type = a.performance_type '
+        'WHERE l.ad_group_id = ? ORDER BY a.position', (ad_group_id,))
+
+  def by_account(self, account_id):
+    """Returns the entries of all assets assigned to the account's ad groups."""
+    return self._entries(
+        'SELECT a.id, a.performance_type, a.data FROM assets a '
+        'WHERE EXISTS (SELECT 1 FROM asset_ad_groups l '
+        'JOIN ad_groups g ON g.id = l.ad_group_id '
+        'WHERE l.asset_id = a.id AND l.performance_type = a.performance_type '
+        'AND g.account_id = ?) ORDER BY a.position', (account_id,))
+
+  def entries(self):
+    """Returns all entries, in index order."""
+    conn = self._conn()
+    links = {}
+    for asset_id, perf_type, link in conn.execute(
+        'SELECT asset_id, performance_type, link FROM asset_ad_groups '
+        'ORDER BY rowid'):
+      links.setdefault((asset_id, perf_type), []).append(json.loads(link))
+    entries = []
+    for asset_id, perf_type, data in conn.execute(
+        'SELECT id, performance_type, data FROM assets ORDER BY position'):
+      entry = json.loads(data)
+      entry['adgroups'] = links.get((asset_id, perf_type), [])
+      entries.append(entry)
+    return entries
+
+  def query(self, filters=None, sort='index', descending=False, cursor=None,
+            limit=DEFAULT_PAGE_SIZE):
+    """Returns a page of the entries that match the filters.
+
+    See asset_store.AssetStore.query.
+    """
+    if sort not in _SORT_COLUMNS:
+      raise ValueError('unknown sort field: ' + sort)
+    if limit < 1:
+      raise ValueError('limit must be at least 1')
+    filters = filters or {}
+    sort_column = _SORT_COLUMNS[sort]
+    conditions = []
+    args = []
+    for field in ('type', 'text_type'):
+      if field in filters:
+        conditions.append(f"json_extract(a.data, '$.{field}') = ?")
+        args.append(filters[field])
+
+    link_conditions = []
+    for field, column in (('adgroup', 'l.ad_group_id'),
+                          ('campaign', 'g.campaign_id'),
+                          ('account', 'g.account_id'),
+                          ('performance',
+                           "json_extract(l.link, '$.performance')")):
+      if field in filters:
+        link_conditions.append(column + ' = ?')
+        args.append(filters[field])
+    if link_conditions:
+      conditions.append(
+          'EXISTS (SELECT 1 FROM asset_ad_groups l '
+          'LEFT JOIN ad_groups g ON g.id = l.ad_group_id '
+          'WHERE l.asset_id = a.id AND l.performance_type = a.performance_type '
+          'AND ' + ' AND '.join(link_conditions) + ')')
+
+    if cursor is not None:
+      conditions.append(
+          f'({sort_column}, a.position) {"<" if descending else ">"} (?, ?)')
+      args += list(cursor)
+
+    order = 'DESC' if descending else 'ASC'
+    rows = self._conn().execute(
+        f'SELECT a.id, a.performance_type, a.data, {sort_column}, a.position '
+        'FROM assets a '
+        + ('WHERE ' + ' AND '.join(conditions) if conditions else '')
+        + f' ORDER BY {sort_column} {order}, a.position {order} LIMIT ?',
+        args + [limit + 1]).fetchall()
+
+    conn = self._conn()
+    page = [dict(self._entry(conn, asset_id, perf_type, data), index=position)
+            for asset_id, perf_type, data, _, position in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+      next_cursor = list(rows[limit - 1][3:])
+    return page, next_cursor
+
+  def version(self):
+    """Returns a token that changes whenever the stored data changes."""
+    return str(self._version)
+
+  def save(self):
+    """Changes are committed by put(), nothing to write."""
+
+  def flush(self):
+    """Writes the assets back to asset_to_ag.json.
+
+    Refreshes build on asset_to_ag.json, so the changes made in the database
+    have to be in it before a refresh, or importing its result loses them.
+    """
+    with self._write_lock:
+      self._flush(self._conn())
+
+  def _flush(self, conn):
+    cache_files.write_list(self._assets_file, self.entries())
+    cache_files.clear_journal(self._assets_file)
+    # the file holds what the database has, no need to import it
+    with conn:
+      conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                   ('source_version', self._source_version()))
+
+  def _account(self, conn, account_id, name):
+    campaigns = []
+    for campaign_id, data in conn.execute(
+        'SELECT id, data FROM campaigns WHERE account_id = ? '
+        'ORDER BY position', (account_id,)):
+      campaign = json.loads(data)
+      campaign['adgroups'] = [
+          json.loads(ad_group) for (ad_group,) in conn.execute(
+              'SELECT data FROM ad_groups '
+              'WHERE campaign_id = ? AND data IS NOT NULL ORDER BY position',
+              (campaign_id,))
+      ]
+      campaigns.append(campaign)
+    return {'id': account_id, 'name': name, 'campaigns': campaigns}
+
+  def get_structure(self):
+    """Returns the structure of all accounts."""
+    conn = self._conn()
+    return [self._account(conn, account_id, name)
+            for account_id, name in conn.execute(
+                'SELECT id, name FROM accounts ORDER BY position').fetchall()]
+
+  def get_account(self, account_id):
+    """Returns the structure of a single account, or None."""
+    conn = self._conn()
+    row = conn.execute(
+        'SELECT name FROM accounts WHERE id = ?', (account_id,)).fetchone()
+    if not row:
+      return None
+    return self._account(conn, account_id, row[0])
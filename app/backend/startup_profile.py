@@ -0,0 +1,118 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Startup report: per-module import times and time to first request.
+
+Enabled by setting ASSETMG_STARTUP_PROFILE=1 before running assetMG.py. The
+report is printed to stderr and written to the log.
+"""
+
+import importlib.abc
+import logging
+import os
+import sys
+import threading
+import time
+
+
+ENABLED = bool(os.environ.get('ASSETMG_STARTUP_PROFILE'))
+REPORT_TOP = 25
+
+_start = time.perf_counter()
+# module name -> [total seconds, seconds spent importing other modules]
+_imports = {}
+_local = threading.local()
+_lock = threading.Lock()
+_first_request = False
+
+
+class _TimingFinder(importlib.abc.MetaPathFinder):
+  """Finds modules with the other finders, timing their loaders."""
+
+  def find_spec(self, name, path, target=None):
+    for finder in sys.meta_path:
+      if finder is self or not hasattr(finder, 'find_spec'):
+        continue
+      spec = finder.find_spec(name, path, target)
+      if spec is not None:
+        if spec.loader and hasattr(spec.loader, 'exec_module'):
+          spec.loader = _TimingLoader(spec.loader)
+        return spec
+    return None
+
+
+class _TimingLoader(importlib.abc.Loader):
+
+  def __init__(self, loader):
+    self._loader = loader
+
+  def __getattr__(self, name):
+    return getattr(self._loader, name)
+
+  def create_module(self, spec):
+    return self._loader.create_module(spec)
+
+  def exec_module(self, module):
+    if not hasattr(_local, 'stack'):
+      _local.stack = []
+    stack = _local.stack
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+      self._loader.exec_module(module)
+    finally:
+      elapsed = time.perf_counter() - start
+      children = stack.pop()
+      if stack:
+        stack[-1] += elapsed
+      _imports[module.__name__] = [elapsed, children]
+
+
+def install():
+  """Starts timing imports, call before importing anything else."""
+  global _start
+  _start = time.perf_counter()
+  if not any(isinstance(f, _TimingFinder) for f in sys.meta_path):
+    sys.meta_path.insert(0, _TimingFinder())
+
+
+def _report(lines):
+  text = '\n'.join(lines)
+  print(text, file=sys.stderr)
+  logging.info(text)
+
+
+def report_imports():
+  """Reports the modules that took the longest to import, by self time."""
+  total = time.perf_counter() - _start
+  by_self_time = sorted(
+      ((elapsed - children, elapsed, name)
+       for name, (elapsed, children) in _imports.items()), reverse=True)
+  lines = ['Startup: %.3fs to load the app, %d modules imported' %
+           (total, len(_imports)),
+           '%10s %10s  module' % ('self (s)', 'total (s)')]
+  for self_time, elapsed, name in by_self_time[:REPORT_TOP]:
+    lines.append('%10.4f %10.4f  %s' % (self_time, elapsed, name))
+  _report(lines)
+
+
+def first_request():
+  """Reports the time to first request, the first time it is called."""
+  global _first_request
+  with _lock:
+    if _first_request:
+      return
+    _first_request = True
+  _report(['Startup: first request after %.3fs' %
+           (time.perf_counter() - _start)])
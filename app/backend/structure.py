@@ -14,11 +14,27 @@
 
 """Module for fetching account structure using Google Ads reporting API."""
 
+import array
+import datetime
 import json
 import logging
+import queue
+import random
+import re
+import shutil
+import threading
 import time
 from concurrent import futures
-from google.ads.google_ads.client import GoogleAdsClient
+from pathlib import Path
+try:
+  from zoneinfo import ZoneInfo
+except ImportError:  # before python 3.9, pytz comes with googleads
+  from pytz import timezone as ZoneInfo
+from app.backend import asset_store
+from app.backend import cache_files
+from app.backend import metrics_cache
+from app.backend import rate_limit
+from app.backend import records
 
 
 logging.basicConfig(level=logging.DEBUG,
@@ -27,29 +43,246 @@ logging.getLogger('google.ads.google_ads.client').setLevel(logging.INFO)
 
 
 _MAX_RETRIES = 3
+_RETRY_BACKOFF = 2
+# accounts built by an interrupted create_mcc_struct, reused for this long
+_CHECKPOINT_DIR = 'checkpoint'
+_CHECKPOINT_TTL = datetime.timedelta(hours=12)
+
+# change_status only holds the changes of the last 90 days. Accounts that were
+# not synced within this window are rebuilt from scratch.
+_CHANGE_WINDOW = datetime.timedelta(days=89)
+_CHANGE_STATUS_LIMIT = 10000
+_CHANGE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# time zone of every account, by customer id. Change times and report dates
+# are in it
+_time_zones = {}
+_STREAM_WORKERS = 4
+# report batches read ahead of the one being processed
+_PREFETCH_BATCHES = 2
+_PREFETCH_POLL = 0.5
 
 class RowsIterator(object):
-  """Streamed report results iterator."""
+  """Streamed report results iterator.
 
-  def __init__(self, response):
+  Once the first batch is in, the following batches are read by a background
+  thread into a bounded queue, so the next batch downloads while the current
+  one is processed. Errors of the stream are raised by the iterator.
+  """
+
+  def __init__(self, response, prefetch=_PREFETCH_BATCHES, release=None):
     self._response = response
+    # called once the stream is over, see rate_limit.RateLimiter.stream
+    self._release = release or _no_release
     self._results = None
+    self._batches = queue.Queue(maxsize=prefetch)
+    self._closed = threading.Event()
+    self._done = False
+
+  def start(self):
+    """Reads the first batch, which is when the request is actually sent."""
+    try:
+      self._results = iter(next(self._response).results)
+    except StopIteration:
+      self._results = iter(())
+      self._done = True
+      self._release(None)
+      return self
+    # the thread doesn't reference the iterator, so an iterator that is
+    # dropped before the end is collected and stops it
+    threading.Thread(
+        target=_prefetch,
+        args=(self._response, self._batches, self._closed, self._release),
+        name='rows-prefetch', daemon=True).start()
+    return self
 
-  def _next_batch(self):
-    self._batch = next(self._response)
-    self._results = iter(self._batch.results)
+  def close(self):
+    """Stops reading the stream, for iterators that aren't read to the end."""
+    if not self._closed.is_set():
+      self._closed.set()
+      cancel = getattr(self._response, 'cancel', None)
+      if cancel and not self._done:
+        cancel()
+      self._release(None)
+
+  def __del__(self):
+    self.close()
 
   def __iter__(self):
     return self
 
   def __next__(self):
     if self._results is None:
-      self._next_batch()
+      self.start()
+    while True:
+      row = next(self._results, None)
+      if row is not None:
+        return row
+      if self._done:
+        raise StopIteration
+      batch = self._batches.get()
+      if batch is _END_OF_STREAM:
+        self._done = True
+        raise StopIteration
+      if isinstance(batch, _StreamError):
+        self._done = True
+        raise batch.error
+      self._results = iter(batch.results)
+
+
+_END_OF_STREAM = object()
+
+
+class _StreamError(object):
+
+  def __init__(self, error):
+    self.error = error
+
+
+def _prefetch(response, batches, closed, release):
+  """Reads the batches of response into the batches queue until closed.
+
+  Calls release once the stream ended or failed, closing releases it
+  otherwise.
+  """
+  try:
+    for batch in response:
+      if not _put(batches, batch, closed):
+        return
+    release(None)
+    item = _END_OF_STREAM
+  except Exception as e:
+    release(e)
+    item = _StreamError(e)
+  _put(batches, item, closed)
+
+
+def _no_release(error=None):
+  pass
+
+
+def _put(batches, item, closed):
+  """Waits for room in the queue, returns False if closed meanwhile."""
+  while not closed.is_set():
     try:
-      return next(self._results)
-    except StopIteration:
-      self._next_batch()
-      return next(self._results)
+      batches.put(item, timeout=_PREFETCH_POLL)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+
+# enum fields are plain ints in the rows, the other fields are wrapped values
+_ENUM_FIELDS = {
+    'asset.type': 'type',
+    'ad_group_ad_asset_view.field_type': 'field_type',
+    'ad_group_ad_asset_view.performance_label': 'performance_label',
+    'ad_group.status': 'adgroup_status',
+    'campaign.status': 'campaign_status',
+}
+_SELECT = re.compile(r'SELECT(.*?)FROM', re.DOTALL | re.IGNORECASE)
+# compiled asset decoders, by SELECT list and enum tables
+_asset_decoders = {}
+
+
+def _enum_names(enum):
+  """Returns the list of the names of an enum's values, indexed by value."""
+  items = enum.items()
+  names = [None] * (max(value for _, value in items) + 1)
+  for name, value in items:
+    names[value] = name
+  return names
+
+
+class _RowDecoder(object):
+  """Compiles row decoding functions specialized for a query.
+
+  Decoders are generated from the query's SELECT list: selected fields are
+  read with plain attribute chains and enums are mapped to their names with
+  lookup tables. Fields the query doesn't select aren't read, their default
+  value is a constant of the generated code.
+  """
+
+  def __init__(self, query, enum_names):
+    self._fields = _select_fields(query)
+    self._enum_names = enum_names
+    self._namespace = {}
+
+  def expr(self, field, default=None):
+    """Returns the Python expression of a row's field, for compile().
+
+    Enum fields are decoded to their name, by default the name of 0.
+    """
+    if field in _ENUM_FIELDS:
+      table = _ENUM_FIELDS[field]
+      names = self._enum_names[table]
+      if field not in self._fields:
+        return repr(names[0])
+      self._namespace[table + '_names'] = names
+      return f'{table}_names[row.{field}]'
+    if field not in self._fields:
+      return repr(default)
+    return f'row.{field}.value'
+
+  def compile(self, source, name, **namespace):
+    """Returns the function name defined by source, a template of field names.
+
+    Every {field} of source is replaced by the field's expression, see expr().
+    """
+    source = _FIELD.sub(
+        lambda match: self.expr(match.group(1), _DEFAULTS.get(match.group(1))),
+        source)
+    namespace.update(self._namespace)
+    # pylint: disable=exec-used
+    exec(compile(source, f'<{name}>', 'exec'), namespace)
+    return namespace[name]
+
+
+def _select_fields(query):
+  """Returns the set of the fields in the SELECT list of a query."""
+  return frozenset(
+      field.strip() for field in _SELECT.search(query).group(1).split(','))
+
+
+_FIELD = re.compile(r'\{([a-z_.]+)\}')
+# defaults of the wrapped fields, as returned by the API when not selected
+_DEFAULTS = {
+    'asset.id': 0,
+    'asset.name': '',
+    'asset.image_asset.full_size.url': '',
+    'asset.image_asset.file_size': 0,
+    'asset.image_asset.full_size.height_pixels': 0,
+    'asset.image_asset.full_size.width_pixels': 0,
+    'asset.text_asset.text': '',
+    'asset.youtube_video_asset.youtube_video_id': '',
+    'metrics.clicks': 0,
+    'metrics.all_conversions': 0.0,
+    'metrics.impressions': 0,
+    'metrics.cost_micros': 0,
+}
+
+_ASSET_DECODER = '''
+def decode(row, assets=None):
+  key = ({asset.id}, {asset.type}, {ad_group_ad_asset_view.field_type})
+  asset = assets.get(key) if assets is not None else None
+  if asset is None:
+    asset = Asset(key[0], {asset.name}, key[1])
+    if key[1] == 'IMAGE':
+      asset.image_url = {asset.image_asset.full_size.url}
+      asset.file_size = {asset.image_asset.file_size}
+      asset.image_height = {asset.image_asset.full_size.height_pixels}
+      asset.image_width = {asset.image_asset.full_size.width_pixels}
+    elif key[1] == 'TEXT':
+      asset.text_type = text_types[key[2]]
+      asset.asset_text = {asset.text_asset.text}
+    elif key[1] == 'YOUTUBE_VIDEO':
+      asset.video_id = {asset.youtube_video_asset.youtube_video_id}
+    if assets is not None:
+      assets[key] = asset
+  return AdGroupAsset(
+      asset, {ad_group_ad_asset_view.performance_label},
+      {metrics.clicks}, {metrics.all_conversions}, {metrics.impressions},
+      {metrics.cost_micros} / 1000000)
+'''
 
 
 class StructureBuilder(object):
@@ -79,46 +312,53 @@ class StructureBuilder(object):
         'performance_label': client.get_type(
             'AssetPerformanceLabelEnum').AssetPerformanceLabel
     }
+    self._enum_names = {
+        key: _enum_names(enum) for key, enum in self._enums.items()}
+    # performance types of the text assets, by field type
+    self._text_types = {
+        name: records.intern(name.lower() + 's')
+        for name in self._enum_names['field_type'] if name}
 
 
   def _get_rows(self, query):
-    response = self._service.search_stream(str(self._customer_id), query)
-    return RowsIterator(response)
-
-
-  def _build_asset(self, row):
-    asset_type = self._enums['type'].Name(row.asset.type)
-    perf_label = self._enums['performance_label'].Name(
-        row.ad_group_ad_asset_view.performance_label)
-    asset = {
-        'id': row.asset.id.value,
-        'name': row.asset.name.value,
-        'type': asset_type,
-        'stats': {
-            'clicks': row.metrics.clicks.value,
-            'all_conversions': row.metrics.all_conversions.value,
-            'impressions': row.metrics.impressions.value,
-            'cost': row.metrics.cost_micros.value / 1000000
-        },
-        'performance': perf_label
-    }
-    if asset_type == 'IMAGE':
-      asset['image_url'] = row.asset.image_asset.full_size.url.value
-      asset['file_size'] = row.asset.image_asset.file_size.value
-      asset['image_height'] = \
-        row.asset.image_asset.full_size.height_pixels.value
-      asset['image_width'] = row.asset.image_asset.full_size.width_pixels.value
-    elif asset_type == 'TEXT':
-      text_type = self._enums['field_type'].Name(
-          row.ad_group_ad_asset_view.field_type)
-      asset['text_type'] = text_type.lower() + 's'
-      asset['asset_text'] = row.asset.text_asset.text.value
-    elif asset_type == 'YOUTUBE_VIDEO':
-      video_id = row.asset.youtube_video_asset.youtube_video_id.value
-      asset['video_id'] = video_id
-      asset['link'] = f'https://www.youtube.com/watch?v={video_id}'
-      asset['image_url'] = f'https://img.youtube.com/vi/{video_id}/1.jpg'
-    return asset
+    # all requests go through the shared limiter, which retries them if the
+    # API throttles us. A stream holds its slot until it is read to the end,
+    # fails or is closed.
+    return rate_limit.limiter.stream(lambda release: RowsIterator(
+        self._service.search_stream(str(self._customer_id), query),
+        release=release).start())
+
+
+  def _asset_decoder(self, query):
+    """Returns a function of (row, assets) returning a row's AdGroupAsset.
+
+    The decoder is compiled for query, see _RowDecoder, once per SELECT list
+    and enum tables. Rows of the same asset share one Asset record through the
+    assets dict.
+    """
+    key = (_select_fields(query), tuple(
+        (table, tuple(names))
+        for table, names in sorted(self._enum_names.items())))
+    decoder = _asset_decoders.get(key)
+    if decoder is None:
+      decoder = _asset_decoders[key] = _RowDecoder(
+          query, self._enum_names).compile(
+              _ASSET_DECODER, 'decode', Asset=records.Asset,
+              AdGroupAsset=records.AdGroupAsset, text_types=self._text_types)
+    return decoder
+
+  def _time_zone(self):
+    time_zone = _time_zones.get(str(self._customer_id))
+    if time_zone is None:
+      rows = self._get_rows('SELECT customer.time_zone FROM customer')
+      for row in rows:
+        time_zone = row.customer.time_zone.value
+      _time_zones[str(self._customer_id)] = time_zone
+    return ZoneInfo(time_zone)
+
+  def _today(self):
+    """Returns the current date in the account's time zone."""
+    return datetime.datetime.now(self._time_zone()).date()
 
   def build(self):
     return None
@@ -128,7 +368,7 @@ class AdGroupAssetsStructureBuilder(StructureBuilder):
   """Ad group assets structure builder class."""
 
   def build(self, ad_group_id):
-    rows = self._get_rows(f'''
+    query = f'''
         SELECT
           ad_group.id,
           asset.id,
@@ -142,15 +382,25 @@ class AdGroupAssetsStructureBuilder(StructureBuilder):
           ad_group_ad_asset_view
         WHERE
           ad_group.id = {ad_group_id}
-    ''')
-    return [self._build_asset(row) for row in rows]
+    '''
+    decode = self._asset_decoder(query)
+    return [decode(row).to_json() for row in self._get_rows(query)]
 
 
 class AccountAssetsBuilder(StructureBuilder):
-  """All assets under an account structure builder."""
+  """All assets under an account structure builder.
+
+  If date_range, a (start, end) tuple of dates, is given, the metrics are
+  those of the range, from the metrics cache. Otherwise they are all-time.
+  """
+
+  def __init__(self, client, customer_id, date_range=None):
+    super().__init__(client, customer_id)
+    self._client = client
+    self._date_range = date_range
 
   def build(self):
-    rows = self._get_rows('''
+    query = '''
         SELECT
           asset.name,
           asset.id,
@@ -163,14 +413,32 @@ class AccountAssetsBuilder(StructureBuilder):
           asset.type
         FROM
           asset
-    ''')
+    '''
+    decode = self._asset_decoder(query)
 
     account_assets = {}
-    for row in rows:
-      asset = self._build_asset(row)
+    for row in self._get_rows(query):
+      asset = decode(row).to_json()
       account_assets[asset['id']] = asset
 
-    source_assets = []
+    if self._date_range:
+      totals = metrics_cache.get_cache().by_asset(
+          self._customer_id, *self._date_range,
+          _metrics_fetcher(self._client, self._customer_id), self._today())
+    else:
+      totals = self._all_time_totals()
+
+    for asset_id, stats in totals.items():
+      asset = account_assets.get(asset_id)
+      if asset:
+        asset['stats']['clicks'] += stats['clicks']
+        asset['stats']['all_conversions'] += stats['all_conversions']
+        asset['stats']['impressions'] += stats['impressions']
+        asset['stats']['cost'] += stats['cost_micros'] / 1000000
+
+    return list(account_assets.values())
+
+  def _all_time_totals(self):
     source_rows = self._get_rows(f'''
         SELECT
           asset.id,
@@ -187,24 +455,176 @@ class AccountAssetsBuilder(StructureBuilder):
           {self._AD_GROUP_FILTER}
     ''')
 
+    ids = array.array('q')
+    columns = {name: array.array(typecode)
+               for name, typecode in _METRIC_COLUMNS.items()}
     for row in source_rows:
-      source_assets.append(self._build_asset(row))
-
-    for asset in source_assets:
-      for k in asset['stats']:
-        account_assets[asset['id']]['stats'][k] += asset['stats'][k]
-
-    return list(account_assets.values())
+      ids.append(row.asset.id.value)
+      metrics = row.metrics
+      columns['clicks'].append(metrics.clicks.value)
+      columns['all_conversions'].append(metrics.all_conversions.value)
+      columns['impressions'].append(metrics.impressions.value)
+      columns['cost_micros'].append(metrics.cost_micros.value)
+    return _sum_by_id(ids, columns)
+
+
+class DailyMetricsBuilder(StructureBuilder):
+  """Daily metrics of every asset in every ad group of an account."""
+
+  def build(self, start, end):
+    """Returns the metrics between the start and end dates, inclusive.
+
+    Returns:
+      list of (day, ad group id, asset id, performance type, clicks,
+      all conversions, impressions, cost micros) tuples, as stored by
+      metrics_cache.
+    """
+    rows = self._get_rows(f'''
+        SELECT
+          segments.date,
+          ad_group.id,
+          asset.id,
+          asset.type,
+          ad_group_ad_asset_view.field_type,
+          metrics.clicks,
+          metrics.all_conversions,
+          metrics.impressions,
+          metrics.cost_micros
+        FROM
+          ad_group_ad_asset_view
+        WHERE
+          {self._CAMPAIGN_FILTER}
+        AND
+          {self._AD_GROUP_FILTER}
+        AND
+          segments.date BETWEEN '{start}' AND '{end}'
+    ''')
+    asset_types = self._enum_names['type']
+    field_types = self._enum_names['field_type']
+    # a row per ad, summed per ad group
+    metrics = {}
+    for row in rows:
+      asset_type = asset_types[row.asset.type]
+      text_type = None
+      if asset_type == 'TEXT':
+        text_type = self._text_types[
+            field_types[row.ad_group_ad_asset_view.field_type]]
+      key = (row.segments.date.value, row.ad_group.id.value,
+             row.asset.id.value,
+             records.performance_type(asset_type, text_type))
+      values = metrics.setdefault(key, [0, 0, 0, 0])
+      values[0] += row.metrics.clicks.value
+      values[1] += row.metrics.all_conversions.value
+      values[2] += row.metrics.impressions.value
+      values[3] += row.metrics.cost_micros.value
+    return [key + tuple(values) for key, values in metrics.items()]
+
+
+def _metrics_fetcher(client, customer_id):
+  return lambda start, end: DailyMetricsBuilder(client, customer_id).build(
+      start, end)
+
+
+def apply_date_range(client, account, date_range):
+  """Returns a copy of an account structure with the metrics of a date range.
+
+  Args:
+    client: GoogleAdsClient, used for the days that aren't cached.
+    account: the account structure, as in account_struct.json.
+    date_range: (start, end) tuple of dates, inclusive.
+  """
+  metrics = metrics_cache.get_cache().by_ad_group_asset(
+      account['id'], *date_range, _metrics_fetcher(client, account['id']),
+      StructureBuilder(client, account['id'])._today())
+  no_metrics = dict.fromkeys(metrics_cache.METRICS, 0)
+
+  def with_metrics(ad_group_id, asset):
+    stats = metrics.get(
+        (ad_group_id, asset['id'], asset_store.performance_type(asset)),
+        no_metrics)
+    return dict(asset, stats={
+        'clicks': stats['clicks'],
+        'all_conversions': stats['all_conversions'],
+        'impressions': stats['impressions'],
+        'cost': stats['cost_micros'] / 1000000,
+    })
+
+  return dict(account, campaigns=[
+      dict(campaign, adgroups=[
+          dict(ad_group, assets=[with_metrics(ad_group['id'], asset)
+                                 for asset in ad_group['assets']])
+          for ad_group in campaign['adgroups']])
+      for campaign in account['campaigns']])
+
+
+def apply_date_range_to_accounts(client, accounts, date_range):
+  """Returns copies of account structures with the metrics of a date range.
+
+  Accounts are fetched concurrently, see apply_date_range. The copies are in
+  the order of accounts.
+  """
+  with futures.ThreadPoolExecutor() as executor:
+    return list(executor.map(
+        lambda account: apply_date_range(client, account, date_range),
+        accounts))
+
+
+# array typecodes of the aggregated metrics
+_METRIC_COLUMNS = {
+    'clicks': 'q',
+    'all_conversions': 'd',
+    'impressions': 'q',
+    'cost_micros': 'q',
+}
+
+
+def _sum_by_id(ids, columns):
+  """Sums the metric columns of the rows of every id.
+
+  Args:
+    ids: array of the id of every row.
+    columns: dict of metric name to an array of its value in every row, of
+      the _METRIC_COLUMNS typecode.
+  Returns:
+    dict of id to a dict of the metric sums.
+  """
+  # numpy is only needed here, it is imported on first use
+  import numpy as np
+
+  if not ids:
+    return {}
+  unique_ids, rows_id = np.unique(
+      np.frombuffer(ids, dtype=np.int64), return_inverse=True)
+  sums = {}
+  for name, typecode in _METRIC_COLUMNS.items():
+    column = np.frombuffer(columns[name], dtype=np.dtype(typecode))
+    column_sums = np.bincount(
+        rows_id, weights=column, minlength=len(unique_ids))
+    if typecode == 'q':
+      column_sums = np.rint(column_sums).astype(np.int64)
+    sums[name] = column_sums.tolist()
+  return {
+      asset_id: {name: sums[name][i] for name in _METRIC_COLUMNS}
+      for i, asset_id in enumerate(unique_ids.tolist())
+  }
 
 
 class AccountStructureBuilder(StructureBuilder):
-  """Account structure builder class."""
+  """Account structure builder class.
 
-  def __init__(self, client, customer_id, name):
+  If campaign_ids is given, only these campaigns (and their ad groups and
+  assets) are built.
+  """
+
+  def __init__(self, client, customer_id, name, campaign_ids=None):
     super().__init__(client, customer_id)
     self._name = name
+    self._campaign_filter = self._CAMPAIGN_FILTER
+    if campaign_ids is not None:
+      ids = ', '.join(str(campaign_id) for campaign_id in campaign_ids)
+      self._campaign_filter += f'  AND campaign.id IN ({ids})'
 
-  def _populate_campaigns_and_ad_groups(self):
+  def _populate_campaigns_and_ad_groups(self, views):
     self._campaigns = []
     self._ad_groups = {}
     campaigns = {}
@@ -217,18 +637,17 @@ class AccountStructureBuilder(StructureBuilder):
         FROM
           campaign
         WHERE
-          {self._CAMPAIGN_FILTER}
+          {self._campaign_filter}
     ''')
+    campaign_statuses = self._enum_names['campaign_status']
     for row in rows:
-      campaign_status = self._enums['campaign_status'].Name(row.campaign.status)
-      campaign = {
-          'id': row.campaign.id.value,
-          'campaign_name': row.campaign.name.value,
-          'status': campaign_status,
-          'adgroups': [],
-      }
+      campaign = records.Campaign(
+          row.campaign.id.value, row.campaign.name.value,
+          campaign_statuses[row.campaign.status])
       self._campaigns.append(campaign)
-      campaigns[campaign['id']] = campaign
+      campaigns[campaign.id] = campaign
+      for view in views:
+        view.add_campaign(campaign)
 
     rows = self._get_rows(f'''
         SELECT
@@ -239,28 +658,28 @@ class AccountStructureBuilder(StructureBuilder):
         FROM
           ad_group
         WHERE
-          {self._CAMPAIGN_FILTER}
+          {self._campaign_filter}
         AND
           {self._AD_GROUP_FILTER}
     ''')
+    ad_group_statuses = self._enum_names['adgroup_status']
     for row in rows:
-      adgroup_status = self._enums['adgroup_status'].Name(row.ad_group.status)
-      ad_group = {
-          'id': row.ad_group.id.value,
-          'name': row.ad_group.name.value,
-          'status': adgroup_status,
-          'assets': [],
-      }
-      campaigns[row.campaign.id.value]['adgroups'].append(ad_group)
-      self._ad_groups[ad_group['id']] = ad_group
-
-  def build(self):
-    structure = {
-        'id': self._customer_id,
-        'name': self._name,
-    }
-    self._populate_campaigns_and_ad_groups()
-    rows = self._get_rows(f'''
+      ad_group = records.AdGroup(
+          row.ad_group.id.value, row.ad_group.name.value,
+          ad_group_statuses[row.ad_group.status])
+      campaign = campaigns[row.campaign.id.value]
+      campaign.ad_groups.append(ad_group)
+      self._ad_groups[ad_group.id] = ad_group
+      for view in views:
+        view.add_ad_group(campaign, ad_group)
+
+  def build_records(self, views=()):
+    """Returns the account structure as a records.Account.
+
+    views, AccountView instances, are filled in the same pass.
+    """
+    self._populate_campaigns_and_ad_groups(views)
+    query = f'''
         SELECT
           ad_group.id,
           asset.id,
@@ -281,15 +700,104 @@ class AccountStructureBuilder(StructureBuilder):
         FROM
           ad_group_ad_asset_view
         WHERE
-          {self._CAMPAIGN_FILTER}
+          {self._campaign_filter}
         AND
           {self._AD_GROUP_FILTER}
-    ''')
-    for row in rows:
-      asset = self._build_asset(row)
-      self._ad_groups[row.ad_group.id.value]['assets'].append(asset)
-    structure['campaigns'] = self._campaigns
-    return structure
+    '''
+    decode = self._asset_decoder(query)
+    assets = {}
+    for row in self._get_rows(query):
+      ad_group = self._ad_groups[row.ad_group.id.value]
+      ad_group_asset = decode(row, assets)
+      ad_group.assets.append(ad_group_asset)
+      for view in views:
+        view.add_asset(ad_group, ad_group_asset)
+    return records.Account(self._customer_id, self._name, self._campaigns)
+
+  def build(self):
+    return self.build_records().to_json()
+
+
+class AccountView(object):
+  """A view derived from an account's campaigns, ad groups and assets.
+
+  Views are filled while AccountStructureBuilder streams the account's rows,
+  so every view of the account comes out of a single pass over the reports.
+  replay() fills them from an already built records.Account instead.
+  """
+
+  def add_campaign(self, campaign):
+    pass
+
+  def add_ad_group(self, campaign, ad_group):
+    pass
+
+  def add_asset(self, ad_group, ad_group_asset):
+    pass
+
+  def result(self):
+    return None
+
+
+class AdGroupsView(AccountView):
+  """The account:adgroups structure, as AccountAdGroupStructureBuilder's."""
+
+  def __init__(self, customer_id):
+    self._structure = {'id': customer_id, 'adgroups': []}
+
+  def add_ad_group(self, campaign, ad_group):
+    self._structure['adgroups'].append({
+        'id': ad_group.id,
+        'name': ad_group.name,
+        'status': ad_group.status,
+        'campaign_id': campaign.id,
+        'campaign_name': campaign.name,
+        'campaign_status': campaign.status
+    })
+
+  def result(self):
+    return self._structure
+
+
+class AssetLinksView(AccountView):
+  """The asset to ad groups links of asset_to_ag.json.
+
+  Links are added to assets, a dict of asset_to_ag entries by (asset id,
+  performance type). The entries are either JSON dicts or records.AssetEntry.
+  """
+
+  def __init__(self, assets=None):
+    self._assets = assets if assets is not None else {}
+
+  def add_asset(self, ad_group, ad_group_asset):
+    key = ad_group_asset.asset.key
+    entry = self._assets.get(key)
+    if entry is None:
+      entry = self._assets[key] = records.AssetEntry(ad_group_asset)
+    if isinstance(entry, dict):
+      entry['adgroups'].append({
+          'id': ad_group.id,
+          'performance': ad_group_asset.performance,
+          'performance_type': key[1],
+      })
+    else:
+      entry.links.append((ad_group.id, ad_group_asset.performance))
+
+  def result(self):
+    return self._assets
+
+
+def replay(campaigns, views):
+  """Fills views from already built records.Campaign."""
+  for campaign in campaigns:
+    for view in views:
+      view.add_campaign(campaign)
+    for ad_group in campaign.ad_groups:
+      for view in views:
+        view.add_ad_group(campaign, ad_group)
+      for ad_group_asset in ad_group.assets:
+        for view in views:
+          view.add_asset(ad_group, ad_group_asset)
 
 
 class AccountAdGroupStructureBuilder(StructureBuilder):
@@ -317,9 +825,11 @@ class AccountAdGroupStructureBuilder(StructureBuilder):
           {self._AD_GROUP_FILTER}
     ''')
 
+    ad_group_statuses = self._enum_names['adgroup_status']
+    campaign_statuses = self._enum_names['campaign_status']
     for row in rows:
-      adgroup_status = self._enums['adgroup_status'].Name(row.ad_group.status)
-      campaign_status = self._enums['campaign_status'].Name(row.campaign.status)
+      adgroup_status = ad_group_statuses[row.ad_group.status]
+      campaign_status = campaign_statuses[row.campaign.status]
 
       ad_group = {
           'id': row.ad_group.id.value,
@@ -334,6 +844,111 @@ class AccountAdGroupStructureBuilder(StructureBuilder):
     return structure
 
 
+class ChangeStatusBuilder(StructureBuilder):
+  """Changed campaigns and ad groups of an account, using change_status."""
+
+  def _change_rows(self, since, until, order=''):
+    return self._get_rows(f'''
+        SELECT
+          change_status.resource_type,
+          change_status.last_change_date_time,
+          change_status.campaign,
+          change_status.ad_group
+        FROM
+          change_status
+        WHERE
+          change_status.last_change_date_time BETWEEN '{since}' AND '{until}'
+        {order}
+        LIMIT {_CHANGE_STATUS_LIMIT}
+    ''')
+
+  def latest_change(self, since, until):
+    """Returns the time of the latest change in the window, or None."""
+    rows = self._change_rows(
+        since, until, 'ORDER BY change_status.last_change_date_time DESC')
+    try:
+      for row in rows:
+        return row.change_status.last_change_date_time.value
+      return None
+    finally:
+      rows.close()
+
+  def build(self, since, until):
+    """Returns the changes made after 'since'.
+
+    Returns:
+      dict with the changed 'campaigns' ids, the changed 'ad_groups' ids mapped
+      to their campaign id (if known), the 'latest' change time and
+      'rebuild_account' if the changes can't be narrowed down to campaigns.
+    """
+    changes = {
+        'campaigns': set(),
+        'ad_groups': {},
+        'latest': since,
+        'rebuild_account': False,
+    }
+    count = 0
+    for row in self._change_rows(since, until):
+      count += 1
+      change_time = row.change_status.last_change_date_time.value
+      # the window is inclusive, skip changes that were already synced
+      if change_time <= since:
+        continue
+      changes['latest'] = max(changes['latest'], change_time)
+      campaign = row.change_status.campaign.value
+      ad_group = row.change_status.ad_group.value
+      campaign_id = int(campaign.split('/')[-1]) if campaign else None
+      if ad_group:
+        changes['ad_groups'][int(ad_group.split('/')[-1])] = campaign_id
+      elif campaign_id:
+        changes['campaigns'].add(campaign_id)
+      else:
+        # change above the campaign level (e.g. a feed)
+        changes['rebuild_account'] = True
+    if count >= _CHANGE_STATUS_LIMIT:
+      changes['rebuild_account'] = True
+    return changes
+
+  def changed_ad_groups(self, snapshots):
+    """Returns the ad groups whose ads changed after their snapshot was taken.
+
+    Args:
+      snapshots: dict of ad group id to the time.time() its ad was read at.
+    """
+    time_zone = self._time_zone()
+    def account_time(timestamp):
+      return datetime.datetime.fromtimestamp(timestamp, time_zone).strftime(
+          _CHANGE_TIME_FORMAT)
+
+    taken = {ad_group_id: account_time(snapshot_time)
+             for ad_group_id, snapshot_time in snapshots.items()}
+    ad_groups = ', '.join(
+        "'customers/%s/adGroups/%s'" % (self._customer_id, ad_group_id)
+        for ad_group_id in taken)
+    rows = self._get_rows(f'''
+        SELECT
+          change_status.ad_group,
+          change_status.last_change_date_time
+        FROM
+          change_status
+        WHERE
+          change_status.resource_type = 'AD_GROUP_AD'
+          AND change_status.ad_group IN ({ad_groups})
+          AND change_status.last_change_date_time BETWEEN
+            '{min(taken.values())}' AND '{account_time(time.time() + 86400)}'
+        LIMIT {_CHANGE_STATUS_LIMIT}
+    ''')
+    changed = set()
+    for row in rows:
+      ad_group_id = int(row.change_status.ad_group.value.split('/')[-1])
+      # the window is inclusive, it holds the change the snapshot was taken
+      # right after
+      if (ad_group_id in taken and
+          row.change_status.last_change_date_time.value > taken[ad_group_id]):
+        changed.add(ad_group_id)
+    return changed
+
+
 class MCCStructureBuilder(StructureBuilder):
   """MCC structure builder class."""
 
@@ -359,64 +974,484 @@ class MCCStructureBuilder(StructureBuilder):
       })
     return accounts
 
-  def build(self):
+  def build(self, progress=None):
+    """Yields the structure of every account as soon as it is built."""
     accounts = self.get_accounts()
-    with futures.ThreadPoolExecutor() as executor:
-      account_structures = executor.map(
-          lambda account: AccountStructureBuilder(
-              self._client, account['id'], account['name']).build(),
-          accounts)
-    return list(account_structures)
-
+    for account in accounts:
+      _report(progress, account['id'], 'pending')
+
+    def build_account(account):
+      _report(progress, account['id'], 'running')
+      try:
+        account_struct = AccountStructureBuilder(
+            self._client, account['id'], account['name']).build()
+      except Exception:
+        _report(progress, account['id'], 'failed')
+        raise
+      _report(progress, account['id'], 'done')
+      return account_struct
 
-def create_mcc_struct(client, mcc_struct_file, assets_file):
-  builder = MCCStructureBuilder(client)
-  for _ in range(_MAX_RETRIES):
+    with futures.ThreadPoolExecutor() as executor:
+      pending = [executor.submit(build_account, account)
+                 for account in accounts]
+      for future in futures.as_completed(pending):
+        yield future.result()
+
+
+def _report(progress, account_id, status):
+  """Reports the status of an account to the progress callback, if any.
+
+  status is one of 'pending', 'running', 'done' and 'failed'.
+  """
+  if progress:
+    progress(account_id, status)
+
+
+def create_mcc_struct(client, mcc_struct_file, assets_file,
+                      sync_state_file=None, progress=None, resume=True):
+  """Builds the whole MCC structure and its asset to ad groups mapping.
+
+  Accounts are built, and retried, one by one. Every built account is
+  checkpointed until the build finishes, so if it is interrupted the next call
+  only builds the missing accounts, unless resume is False. Accounts that
+  fail keep their previously cached structure, if there is one, and are
+  reported as stale.
+
+  Accounts are written to the cache files as soon as they are built, in the
+  order they complete, so only the accounts being built are held in memory.
+
+  If sync_state_file is given, the sync state of every account is saved to it,
+  so later calls to sync_mcc_struct only rebuild what changed.
+  progress is called with (account id, status) as every account is built.
+
+  Returns:
+    dict with the ids of the 'built' and 'resumed' (from a checkpoint)
+    accounts, and the 'stale' accounts with their error.
+  """
+  accounts = _retry(lambda: MCCStructureBuilder(client).get_accounts(),
+                    'get accounts')
+  checkpoints = _Checkpoints(mcc_struct_file)
+  if resume:
+    resumed = checkpoints.available({account['id'] for account in accounts})
+  else:
+    # checkpoints of an earlier build aren't mixed with the ones of this one
+    checkpoints.clear()
+    resumed = set()
+  for account in accounts:
+    _report(progress, account['id'],
+            'done' if account['id'] in resumed else 'pending')
+
+  def build_account(account):
+    _report(progress, account['id'], 'running')
     try:
-      structure = builder.build()
+      result = _retry(lambda: _build_account(client, account),
+                      'build account %s' % account['id'])
     except Exception as e:
-      logging.exception(e)
-      err_msg = e.args[0]
-      time.sleep(10)
-      continue
+      _report(progress, account['id'], 'failed')
+      return e
+    checkpoints.save(account['id'], result)
+    _report(progress, account['id'], 'done')
+    return result
+
+  cached_sync_state = (
+      _read_sync_state(sync_state_file) if sync_state_file else {})
+  sync_state = {}
+  stale = []
+
+  with cache_files.structure_writer(mcc_struct_file) as add_account, \
+       cache_files.list_writer(assets_file) as add_entry:
+
+    def write_account(account, result):
+      add_account(result['structure'].to_json())
+      if result['sync_state']:
+        sync_state[str(account['id'])] = result['sync_state']
+      # an asset belongs to a single account, so its entry is complete
+      assets = {}
+      _merge_asset_links(assets, result)
+      for entry in assets.values():
+        add_entry(entry.to_json())
+
+    for account in accounts:
+      if account['id'] in resumed:
+        try:
+          checkpoint = checkpoints.read(account['id'])
+        except (OSError, ValueError, KeyError):
+          logging.warning('Could not read the checkpoint of %s',
+                          account['id'], exc_info=True)
+          resumed.discard(account['id'])
+          _report(progress, account['id'], 'pending')
+          continue
+        write_account(account, checkpoint)
+
+    with futures.ThreadPoolExecutor() as executor:
+      pending = {executor.submit(build_account, account): account
+                 for account in accounts if account['id'] not in resumed}
+      for future in futures.as_completed(pending):
+        account = pending.pop(future)
+        result = future.result()
+        if isinstance(result, Exception):
+          stale.append({'id': account['id'], 'name': account['name'],
+                        'error': str(result)})
+          result = _read_cached_account(
+              mcc_struct_file, account['id'],
+              cached_sync_state.get(str(account['id'])))
+          if result is None:
+            continue
+        write_account(account, result)
+
+    if len(stale) == len(accounts) and accounts:
+      # nothing was built, the cache files are left as they are
+      logging.error('Could not create structure')
+      raise ConnectionError(stale[0]['error'])
+
+  # the sync state goes last, if the other files aren't written the next sync
+  # redoes the changes
+  if sync_state_file:
+    cache_files.write_json(sync_state_file, sync_state)
+  # the build is done, stale accounts are rebuilt by the next one
+  checkpoints.clear()
+
+  if stale:
+    logging.warning('Structure created, stale accounts: %s',
+                    ', '.join(str(account['id']) for account in stale))
+  stale_ids = {account['id'] for account in stale}
+  return {
+      'built': [account['id'] for account in accounts
+                if account['id'] not in resumed
+                and account['id'] not in stale_ids],
+      'resumed': sorted(resumed),
+      'stale': stale,
+  }
+
+
+def _build_account(client, account):
+  """Builds an account's structure and its sync state."""
+  now = datetime.datetime.utcnow()
+  # the sync state is taken before building, so changes made during the
+  # build are picked up by the next sync
+  sync_state = _get_sync_state(client, account['id'], now)
+  links = AssetLinksView()
+  structure = AccountStructureBuilder(
+      client, account['id'], account['name']).build_records([links])
+  return {'structure': structure, 'sync_state': sync_state,
+          'asset_links': links.result()}
+
+
+def _merge_asset_links(assets, result):
+  """Adds an account's asset links to the asset_to_ag entries in assets.
+
+  Accounts built by create_mcc_struct come with the links collected while
+  they were built, the others (resumed or stale) are replayed.
+  """
+  links = result.get('asset_links')
+  if links is None:
+    replay(result['structure'].campaigns, [AssetLinksView(assets)])
+    return
+  for key, entry in links.items():
+    merged = assets.get(key)
+    if merged is None:
+      assets[key] = entry
     else:
-      break
+      merged.links += entry.links
+
 
+def _retry(fn, description):
+  """Calls fn, retrying it with exponential backoff when it fails."""
+  for attempt in range(_MAX_RETRIES):
+    try:
+      return fn()
+    except Exception:
+      if attempt == _MAX_RETRIES - 1:
+        logging.exception('Could not %s', description)
+        raise
+      delay = _RETRY_BACKOFF * 2 ** attempt * random.uniform(1, 1.5)
+      logging.warning('Could not %s, retrying in %.1fs', description, delay,
+                      exc_info=True)
+      time.sleep(delay)
+
+
+def _read_cached_account(mcc_struct_file, account_id, sync_state):
+  """Returns the cached structure of an account that could not be built.
+
+  Returns:
+    the account like _build_account's result, or None if it isn't cached.
+  """
+  try:
+    cached = cache_files.read_account(mcc_struct_file, account_id)
+  except (FileNotFoundError, ValueError):
+    cached = None
+  if cached is None:
+    return None
+  return {'structure': records.Account.from_json(cached),
+          'sync_state': sync_state}
+
+
+def _read_sync_state(sync_state_file):
+  try:
+    with open(sync_state_file, 'r') as f:
+      return json.load(f)
+  except (FileNotFoundError, json.JSONDecodeError):
+    return {}
+
+
+class _Checkpoints(object):
+  """Account structures built so far by an unfinished create_mcc_struct.
+
+  They are cleared once the build finishes, so only an interrupted build is
+  resumed.
+  """
+
+  def __init__(self, mcc_struct_file):
+    self._dir = Path(mcc_struct_file).parent / _CHECKPOINT_DIR
+
+  def _path(self, account_id):
+    return self._dir / ('%s.json' % account_id)
+
+  def available(self, account_ids):
+    """Returns the ids of the given accounts that have a recent checkpoint."""
+    available = set()
+    if not self._dir.is_dir():
+      return available
+    oldest = time.time() - _CHECKPOINT_TTL.total_seconds()
+    for account_id in account_ids:
+      try:
+        if self._path(account_id).stat().st_mtime >= oldest:
+          available.add(account_id)
+      except OSError:
+        continue
+    if available:
+      logging.info('Resuming structure build, %d accounts already built',
+                   len(available))
+    return available
+
+  def read(self, account_id):
+    """Returns the checkpoint of an account, as _build_account's result."""
+    with open(self._path(account_id), 'r') as f:
+      checkpoint = json.load(f)
+    return {
+        'structure': records.Account.from_json(checkpoint['structure']),
+        'sync_state': checkpoint['sync_state'],
+    }
+
+  def save(self, account_id, checkpoint):
+    self._dir.mkdir(parents=True, exist_ok=True)
+    cache_files.write_json(self._path(account_id), {
+        'structure': checkpoint['structure'].to_json(),
+        'sync_state': checkpoint['sync_state'],
+    }, indent=None)
+
+  def clear(self):
+    if self._dir.is_dir():
+      shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def sync_mcc_struct(client, mcc_struct_file, assets_file, sync_state_file,
+                    progress=None):
+  """Updates the cached MCC structure with the changes since the last sync.
+
+  Uses change_status to find the campaigns that changed in every account and
+  rebuilds only them, then patches both cache files. Accounts that are new or
+  were not synced within the change_status window are rebuilt in full. If
+  there is no cached structure, falls back to create_mcc_struct.
+  Note that metrics of unchanged campaigns are refreshed only by a full build.
+  progress is called with (account id, status) as every account is synced.
+
+  As in create_mcc_struct, cached accounts are read one by one and written as
+  soon as they are synced, so only the accounts being synced are held in
+  memory, along with the asset links of the rebuilt campaigns.
+
+  Returns:
+    dict like create_mcc_struct's. Accounts that could not be synced keep
+    their cached structure and are reported as 'stale'.
+  """
+  try:
+    cached_ids = set(cache_files.account_ids(mcc_struct_file))
+    with open(sync_state_file, 'r') as f:
+      sync_state = json.load(f)
+    asset_struct = cache_files.iter_list(assets_file)
+  except (FileNotFoundError, ValueError):
+    logging.info('No synced structure found, creating full structure')
+    return create_mcc_struct(client, mcc_struct_file, assets_file,
+                             sync_state_file, progress)
+
+  now = datetime.datetime.utcnow()
+  accounts = _retry(lambda: MCCStructureBuilder(client).get_accounts(),
+                    'get accounts')
+  stale = []
+
+  for account in accounts:
+    _report(progress, account['id'], 'pending')
+
+  def read_cached(account_id):
+    if account_id not in cached_ids:
+      return None
+    try:
+      return cache_files.read_account(mcc_struct_file, account_id)
+    except ValueError:
+      logging.warning('Could not read the cached structure of %s',
+                      account_id, exc_info=True)
+      return None
+
+  def sync_account(account):
+    # returns _sync_account's result and the ad groups whose asset links are
+    # replaced by the rebuilt campaigns
+    _report(progress, account['id'], 'running')
+    cached = read_cached(account['id'])
+    try:
+      account_struct, state, campaign_ids = _retry(
+          lambda: _sync_account(
+              client, account, cached, sync_state.get(str(account['id'])),
+              now),
+          'sync account %s' % account['id'])
+    except Exception as e:
+      _report(progress, account['id'], 'failed')
+      stale.append(
+          {'id': account['id'], 'name': account['name'], 'error': str(e)})
+      return cached, sync_state.get(str(account['id'])), set(), set()
+    _report(progress, account['id'], 'done')
+    replaced_ad_groups = set()
+    if cached:
+      replaced_ad_groups = _ad_group_ids(
+          [c for c in cached['campaigns'] if c['id'] in campaign_ids])
+    return account_struct, state, campaign_ids, replaced_ad_groups
+
+  # ad groups whose asset links are replaced by the rebuilt campaigns
+  stale_ad_groups = set()
+  links = AssetLinksView()
+  rebuilt_campaigns = 0
+  new_sync_state = {}
+  synced_ids = set()
+  with cache_files.structure_writer(mcc_struct_file) as add_account:
+    with futures.ThreadPoolExecutor() as executor:
+      pending = {executor.submit(sync_account, account): account
+                 for account in accounts}
+      for future in futures.as_completed(pending):
+        account = pending.pop(future)
+        account_struct, state, campaign_ids, replaced_ad_groups = (
+            future.result())
+        if account_struct is None:
+          continue
+        add_account(account_struct)
+        synced_ids.add(account['id'])
+        if state:
+          new_sync_state[str(account['id'])] = state
+        stale_ad_groups.update(replaced_ad_groups)
+        rebuilt = [records.Campaign.from_json(c, {})
+                   for c in account_struct['campaigns']
+                   if c['id'] in campaign_ids]
+        rebuilt_campaigns += len(rebuilt)
+        replay(rebuilt, [links])
+
+    # accounts that were removed from the MCC, read before the structure file
+    # is replaced
+    for account_id in cached_ids - synced_ids:
+      cached = read_cached(account_id)
+      if cached:
+        stale_ad_groups.update(_ad_group_ids(cached['campaigns']))
+
+  new_links = links.result()
+  with cache_files.list_writer(assets_file) as add_entry:
+    for asset in asset_struct:
+      adgroups = [ag for ag in asset['adgroups']
+                  if ag['id'] not in stale_ad_groups]
+      if adgroups or not asset['adgroups']:
+        entry = new_links.pop(_asset_key(asset), None)
+        if entry is not None:
+          adgroups += entry.to_json()['adgroups']
+        asset['adgroups'] = adgroups
+        add_entry(asset)
+    # assets that are new, or whose links were all replaced
+    for entry in new_links.values():
+      add_entry(entry.to_json())
+  cache_files.write_json(sync_state_file, new_sync_state)
+
+  logging.info('Synced structure: %d campaigns rebuilt, %d accounts',
+               rebuilt_campaigns, len(synced_ids))
+  stale_ids = {account['id'] for account in stale}
+  if stale:
+    logging.warning('Stale accounts: %s', ', '.join(map(str, stale_ids)))
+  return {
+      'built': [account['id'] for account in accounts
+                if account['id'] not in stale_ids],
+      'resumed': [],
+      'stale': stale,
+  }
+
+
+def _sync_account(client, account, cached, state, now):
+  """Brings a single account's structure up to date.
+
+  Returns:
+    tuple of the account structure, its new sync state and the ids of the
+    campaigns that were rebuilt.
+  """
+  account_id = account['id']
+  rebuild_account = (
+      not cached or not state
+      or state['synced_at'] < (now - _CHANGE_WINDOW).isoformat())
+
+  if rebuild_account:
+    new_state = _get_sync_state(client, account_id, now)
   else:
-    logging.error('Could not create structure')
-    raise ConnectionError(err_msg)
-
-  with open(mcc_struct_file, 'w') as f:
-    json.dump(structure, f, indent=2)
-  assets = {}
-  for account in structure:
-    for campaign in account['campaigns']:
-      for ad_group in campaign['adgroups']:
-        for asset in ad_group['assets']:
-          try:
-            performance_type = 'nontext'
-            if asset['type'] == 'TEXT':
-              performance_type = asset['text_type']
-            key = str(asset['id']) + performance_type
-
-            assets[key]['adgroups'].append(
-                {
-                    'id': ad_group['id'],
-                    'performance': asset['performance'],
-                    'performance_type': performance_type
-                }
-            )
-          except KeyError:
-            assets[key] = asset
-            assets[key]['adgroups'] = [
-                {
-                    'id': ad_group['id'],
-                    'performance': asset['performance'],
-                    'performance_type': performance_type
-                }
-            ]
-  with open(assets_file, 'w') as f:
-    json.dump(list(assets.values()), f, indent=2)
+    window_start = (now - _CHANGE_WINDOW).strftime(_CHANGE_TIME_FORMAT)
+    changes = ChangeStatusBuilder(client, account_id).build(
+        max(state['watermark'], window_start), _change_window_end(now))
+    new_state = {'synced_at': now.isoformat(), 'watermark': changes['latest']}
+    rebuild_account = changes['rebuild_account']
+
+    campaign_ids = changes['campaigns']
+    ad_group_campaigns = {
+        ad_group['id']: campaign['id']
+        for campaign in cached['campaigns']
+        for ad_group in campaign['adgroups']
+    }
+    for ad_group_id, campaign_id in changes['ad_groups'].items():
+      campaign_id = ad_group_campaigns.get(ad_group_id, campaign_id)
+      if campaign_id is None:
+        rebuild_account = True
+      else:
+        campaign_ids.add(campaign_id)
+
+  if rebuild_account:
+    account_struct = AccountStructureBuilder(
+        client, account_id, account['name']).build()
+    campaign_ids = {c['id'] for c in account_struct['campaigns']}
+    if cached:
+      campaign_ids.update(c['id'] for c in cached['campaigns'])
+    return account_struct, new_state, campaign_ids
+
+  if not campaign_ids:
+    return dict(cached, name=account['name']), new_state, campaign_ids
+
+  partial = AccountStructureBuilder(
+      client, account_id, account['name'], campaign_ids).build()
+  campaigns = [c for c in cached['campaigns'] if c['id'] not in campaign_ids]
+  campaigns += partial['campaigns']
+  return (dict(cached, name=account['name'], campaigns=campaigns),
+          new_state, campaign_ids)
+
+
+def _get_sync_state(client, customer_id, now):
+  """Returns the sync state of an account that is about to be fully built."""
+  # change times are in the account's time zone, a day back covers all zones
+  default = (now - datetime.timedelta(days=1)).strftime(_CHANGE_TIME_FORMAT)
+  latest = ChangeStatusBuilder(client, customer_id).latest_change(
+      (now - _CHANGE_WINDOW).strftime(_CHANGE_TIME_FORMAT),
+      _change_window_end(now))
+  return {'synced_at': now.isoformat(), 'watermark': latest or default}
+
+
+def _change_window_end(now):
+  return (now + datetime.timedelta(days=1)).strftime(_CHANGE_TIME_FORMAT)
+
+
+def _ad_group_ids(campaigns):
+  return {ad_group['id']
+          for campaign in campaigns for ad_group in campaign['adgroups']}
+
+
+def _asset_key(asset):
+  return asset['id'], asset_store.performance_type(asset)
 
 
 def get_accounts(client):
@@ -424,33 +1459,92 @@ def get_accounts(client):
   return sorted(builder.get_accounts(), key=lambda item: item['name'])
 
 
+def get_synced_at(sync_state_file, customer_id):
+  """Returns when an account's cached structure was last synced, or None."""
+  state = _read_sync_state(sync_state_file).get(str(customer_id))
+  return state['synced_at'] if state else None
+
+
+def get_changed_ad_groups(client, customer_id, snapshots):
+  builder = ChangeStatusBuilder(client, customer_id)
+  return builder.changed_ad_groups(snapshots)
+
+
 def get_assets_from_adgroup(client, customer_id, ad_group_id):
   builder = AdGroupAssetsStructureBuilder(client, customer_id)
   return builder.build(ad_group_id)
 
 
-def get_accounts_assets(client, customer_id):
-  builder = AccountAssetsBuilder(client, customer_id)
+def get_accounts_assets(client, customer_id, date_range=None):
+  builder = AccountAssetsBuilder(client, customer_id, date_range)
   return sorted(builder.build(),
                 key = lambda item: item['stats']['clicks'], reverse=True)
 
-def get_all_accounts_assets(client):
+def get_all_accounts_assets(client, date_range=None):
   accounts = get_accounts(client)
   with futures.ThreadPoolExecutor() as executor:
     account_assets = executor.map(
-        lambda account: get_accounts_assets(client, str(account['id'])),
+        lambda account: get_accounts_assets(
+            client, str(account['id']), date_range),
         accounts)
   for account, assets in zip(accounts, account_assets):
     account['assets'] = assets
   return accounts
 
-def get_account_adgroup_structure(client, customer_id):
-  """Account structre of the form account:adgroups."""
+def iter_all_accounts_assets(client, max_workers=_STREAM_WORKERS,
+                             date_range=None):
+  """Yields every account with its assets, as soon as each one is built.
+
+  At most max_workers accounts are being built or waiting to be consumed at a
+  time, so memory is bounded by a few accounts rather than the whole MCC.
+  Accounts that failed are yielded with an 'error' instead of 'assets'.
+  """
+  accounts = iter(get_accounts(client))
+  with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    pending = {}
+
+    def submit_next():
+      for account in accounts:
+        future = executor.submit(
+            get_accounts_assets, client, str(account['id']), date_range)
+        pending[future] = account
+        return
+
+    for _ in range(max_workers):
+      submit_next()
+
+    while pending:
+      done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+      for future in done:
+        account = pending.pop(future)
+        try:
+          account['assets'] = future.result()
+        except Exception as e:
+          logging.exception('Failed getting assets for: %s', account['id'])
+          account['error'] = str(e)
+        submit_next()
+        yield account
+
+
+def get_account_adgroup_structure(client, customer_id, cached=None,
+                                  synced_at=None):
+  """Account structre of the form account:adgroups.
+
+  If cached, the account's cached structure, is given it is derived from it
+  instead of querying the API, and synced_at, when the cache was last synced,
+  is added to it.
+  """
+  if cached is not None:
+    view = AdGroupsView(customer_id)
+    replay([records.Campaign.from_json(campaign)
+            for campaign in cached['campaigns']], [view])
+    return dict(view.result(), synced_at=synced_at)
   builder = AccountAdGroupStructureBuilder(client, customer_id)
   return builder.build()
 
 
 if __name__ == '__main__':
+  from google.ads.google_ads.client import GoogleAdsClient
   googleads_client = GoogleAdsClient.load_from_storage(
       'app/config/google-ads.yaml')
   # create_mcc_struct(googleads_client,
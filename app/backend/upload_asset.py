@@ -22,12 +22,10 @@ import app.backend.mutate as mutate
 from app.backend.structure import get_assets_from_adgroup
 from app.backend.service import Service_Class
 from app.backend.error_handling import error_mapping
-from pathlib import Path
+from app.backend import asset_store
 import urllib
-import json
 
 
-asset_to_ag_json_path = Path('app/cache/asset_to_ag.json')
 yt_thumbnail_url = 'https://img.youtube.com/vi/%s/1.jpg'
 
 
@@ -150,16 +148,22 @@ def _assign_new_asset_to_adgroups(client, googleads_client, account, asset,
   if not adgroups:
     return {'asset': asset, 'status': -1}
 
-  for ag in adgroups:
-    # mutate_ad returns None if it finishes succesfully
-    try:
-      mutate.mutate_ad(client, account, ag, asset, 'ADD', text_type)
-      successeful_assign.append({"id": ag})
-    except Exception as e:
+  # mutate_ads returns None for every adgroup it assigned succesfully
+  errors = mutate.mutate_ads(client, [{
+      'account': account,
+      'adgroup': ag,
+      'asset': asset,
+      'action': 'ADD',
+      'text_type_to_assign': text_type,
+  } for ag in adgroups], googleads_client)
+  for ag, e in zip(adgroups, errors):
+    if e:
       unsuccesseful_assign.append({
           'adgroup': ag,
           'error_message': error_mapping(str(e)), 'err': str(e)
       })
+    else:
+      successeful_assign.append({"id": ag})
   # assignment status:
   #   0 - succesfull,
   #   1 - partialy succesfull,
@@ -187,7 +191,7 @@ def _assign_new_asset_to_adgroups(client, googleads_client, account, asset,
         googleads_client, account, asset, successeful_assign[0])
 
   asset['adgroups'] = successeful_assign
-  _update_asset_struct(asset)
+  _update_asset_struct(asset, account)
 
   return {
       'asset': asset,
@@ -197,15 +201,14 @@ def _assign_new_asset_to_adgroups(client, googleads_client, account, asset,
   }
 
 
-def _update_asset_struct(asset):
-  """Update the asset_to_ag file with the new assets and their adgroups"""
-  with open(asset_to_ag_json_path, 'r') as f:
-    struct = json.load(f)
-
-  struct.append(asset)
-
-  with open(asset_to_ag_json_path, 'w') as f:
-    json.dump(struct, f, indent=2)
+def _update_asset_struct(asset, account):
+  """Update the asset store with the new assets and their adgroups"""
+  store = asset_store.get_store()
+  for ag in asset['adgroups']:
+    store.assign_account(ag['id'], account)
+  # an identical asset may already exist, its adgroups are kept
+  store.add_links(asset, asset['adgroups'])
+  store.save()
 
 
 def _extract_text_asset_info(googleads_client, account, thin_asset, adgroup):
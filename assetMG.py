@@ -13,30 +13,34 @@
 # limitations under the License.
 
 """ server configuration for the assetMG tool"""
+from app.backend import startup_profile
+if startup_profile.ENABLED:
+  startup_profile.install()
+
+import base64
 import json
 from flask import Flask, request, jsonify, render_template
-from googleads import adwords
-from google.ads.google_ads.client import GoogleAdsClient
 import app.backend.setup as setup
-from app.backend.mutate import mutate_ad
+from app.backend.mutate import mutate_ads, ad_cache
 from app.backend import structure
+from app.backend import asset_store
+from app.backend import cache_files
+from app.backend import metrics_cache
+from app.backend.jobs import JobManager
+from app.backend.response_cache import ResponseCache
 from app.backend.upload_asset import upload
 from app.backend.service import Service_Class
-from app.backend.yt_upload import initialize_upload
 from app.backend.error_handling import error_mapping
-from googleapiclient.discovery import build
 from pathlib import Path
-import copy
 import logging
 import yaml
-from google_auth_oauthlib.flow import InstalledAppFlow
 import webbrowser
 import threading
 import sys
 import os
 import shutil
+from werkzeug.serving import WSGIRequestHandler
 from werkzeug.utils import secure_filename
-import webview
 import string
 
 
@@ -67,16 +71,81 @@ YT_CLIENT_SCOPES = ['https://www.googleapis.com/auth/youtube.upload']
 
 asset_to_ag_json_path = Path('app/cache/asset_to_ag.json')
 account_struct_json_path = Path('app/cache/account_struct.json')
+sync_state_json_path = Path('app/cache/sync_state.json')
 
 logging.basicConfig(filename=LOGS_PATH,
                     level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(message)s')
 
-client=''
-googleads_client=''
+# the API clients are built on first use, see _get_client()
+client = None
+googleads_client = None
+_clients_lock = threading.RLock()
+response_cache = ResponseCache()
+job_manager = JobManager()
+# descriptions of the structure refresh jobs
+_SYNC = 'structure sync'
+_FULL_BUILD = 'full structure build'
+
+
+def _load_clients():
+  """Builds both API clients from the config files.
+
+  The client libraries are imported here, they are slow to import and not
+  needed until the app is configured.
+  """
+  from googleads import adwords
+  from google.ads.google_ads.client import GoogleAdsClient
+  global client
+  global googleads_client
+  with _clients_lock:
+    client = adwords.AdWordsClient.LoadFromStorage(
+      CONFIG_PATH / 'googleads.yaml')
+    googleads_client = GoogleAdsClient.load_from_storage(
+      CONFIG_PATH / 'google-ads.yaml')
+    # the services of the previous clients
+    Service_Class.clear()
+
+
+def _get_client():
+  """Returns the AdWords client, building it on first use."""
+  with _clients_lock:
+    if client is None:
+      _load_clients()
+    return client
+
+
+def _get_googleads_client():
+  """Returns the Google Ads client, building it on first use."""
+  _get_client()
+  return googleads_client
+
+
+def _refresh_structure(job, full):
+  """Syncs (or fully rebuilds) the cached structure, run as a job.
+
+  The cache files are swapped in atomically, requests keep being served from
+  the previous files until the refresh is done. Asset changes made meanwhile
+  are applied on top of the refreshed files. Returns the refresh report,
+  which lists the accounts that are stale.
+  """
+  with asset_store.get_store().refreshing():
+    if full:
+      # a full rebuild is asked for fresh data, it doesn't resume an earlier
+      # interrupted build
+      report = structure.create_mcc_struct(
+          _get_googleads_client(), account_struct_json_path,
+          asset_to_ag_json_path, sync_state_json_path, progress=job.progress,
+          resume=False)
+    else:
+      report = structure.sync_mcc_struct(
+          _get_googleads_client(), account_struct_json_path,
+          asset_to_ag_json_path, sync_state_json_path, progress=job.progress)
+  ad_cache.clear()
+  return report
 
 
-# check if config is valid. if yes, init clients and create struct
+# check if config is valid. if yes, init clients and serve the cached structure
 try:
   with open(CONFIG_FILE_PATH, 'r') as f:
     config_file = yaml.load(f, Loader=yaml.FullLoader)
@@ -85,16 +154,21 @@ except FileNotFoundError:
 
 if config_file['config_valid']:
   setup.set_api_configs()
-  client = adwords.AdWordsClient.LoadFromStorage(
-    CONFIG_PATH / 'googleads.yaml')
-  googleads_client = GoogleAdsClient.load_from_storage(
-    CONFIG_PATH / 'google-ads.yaml')
-  try:
-    structure.create_mcc_struct(
-        googleads_client, account_struct_json_path, asset_to_ag_json_path)
-  except Exception as e:
-    logging.exception('Error when trying to create struct')
-    Service_Class.reset_cid(client)
+  # the cached structure is served while it is refreshed in the background
+  structure_age = cache_files.age(account_struct_json_path)
+  if structure_age is not None:
+    logging.info('Serving cached structure from %.0f minutes ago',
+                 structure_age / 60)
+
+  def startup_refresh(job):
+    try:
+      return _refresh_structure(job, full=False)
+    except Exception:
+      if client is not None:
+        Service_Class.reset_cid(client)
+      raise
+
+  job_manager.submit('structure', _SYNC, startup_refresh)
 
 
 @server.route('/')
@@ -145,6 +219,7 @@ def set_secret():
       'successfully restored previous configs'), status=200)
 
   try:
+    from google_auth_oauthlib.flow import InstalledAppFlow
     client_config = {
         'installed': {
             'client_id': data['client_id'],
@@ -191,6 +266,9 @@ def set_refresh_token():
 @server.route('/init-yt/', methods=['GET'])
 def init_yt():
   """opens a browser with the login window. """
+  # the YouTube client libraries are only needed for YouTube uploads
+  from google_auth_oauthlib.flow import InstalledAppFlow
+  from googleapiclient.discovery import build
   setup.set_yt_config()
   yt_flow = InstalledAppFlow.from_client_secrets_file(
     YT_CONFIG_FILE_PATH , YT_CLIENT_SCOPES)
@@ -224,6 +302,7 @@ def upload_to_yt():
   if data.get('file') is None:
     return _build_response(msg=json.loads('File not specified', status=404))
   try:
+    from app.backend.yt_upload import initialize_upload
     id = initialize_upload(
       yt_client,**{k: v for k, v in data.items() if v is not None})
     status=200
@@ -238,24 +317,53 @@ def upload_to_yt():
 
 @server.route('/create-struct/', methods=['GET'])
 def create_struct():
-  msg = ''
-  try:
-    structure.create_mcc_struct(
-        googleads_client, account_struct_json_path, asset_to_ag_json_path)
-    status=200
-  except Exception as e:
-    status=403
-    msg = str(e)
-    logging.exception(e)
+  """Starts a background job syncing the cached structure.
+
+  Pass full=1 to rebuild the whole structure instead. Returns the job, whose
+  progress is available at /jobs/<id>/. If a structure refresh is already
+  running, its job is returned instead of starting another one. A full
+  rebuild requested while a sync is running isn't started, it returns 409
+  with the running job.
+  """
+  full = request.args.get('full') in ('1', 'true')
+  job, started = job_manager.submit(
+      'structure', _FULL_BUILD if full else _SYNC,
+      lambda job: _refresh_structure(job, full))
+  if full and not started and job.description != _FULL_BUILD:
+    return _build_response(msg=json.dumps({
+        'msg': 'A structure sync is already running, '
+               'request the full rebuild once it is done',
+        'job': job.to_dict(),
+    }), status=409)
+  return _build_response(msg=json.dumps(job.to_dict()), status=202)
+
+
+@server.route('/cache-status/', methods=['GET'])
+def get_cache_status():
+  """Returns the age of the cached structure and the running refresh, if any.
+  """
+  refresh = job_manager.running('structure')
+  return _build_response(msg=json.dumps({
+      'structure_age': cache_files.age(account_struct_json_path),
+      'assets_age': cache_files.age(asset_to_ag_json_path),
+      'refresh': refresh.to_dict() if refresh else None,
+  }), status=200)
+
 
-  return _build_response(msg=msg,status=status)
+@server.route('/jobs/<job_id>/', methods=['GET'])
+def get_job(job_id):
+  """Returns the status and per-account progress of a background job."""
+  job = job_manager.get(job_id)
+  if not job:
+    return _build_response(msg='job not found', status=404)
+  return _build_response(msg=json.dumps(job.to_dict()), status=200)
 
 
 @server.route('/accounts/', methods=['GET'])
 def get_all_accounts():
   """gets all accounts under the configured MCC. name and id"""
   try:
-    accounts = structure.get_accounts(googleads_client)
+    accounts = structure.get_accounts(_get_googleads_client())
     return _build_response(msg=json.dumps(accounts), status=200)
   except Exception as e:
     return _build_response(msg=str(e), status=403)
@@ -263,10 +371,28 @@ def get_all_accounts():
 
 @server.route('/account-ag-struct', methods=['GET'])
 def get_account_ag_struct():
-  """Get account's adgroups structure."""
+  """Get account's adgroups structure.
+
+  The ad groups are queried from the API. With cached=1 they are taken from
+  the cached structure instead, if the account is cached, along with the time
+  it was last synced (synced_at).
+  """
   cid = request.args.get('cid')
   try:
-    msg = json.dumps(structure.get_account_adgroup_structure(googleads_client,cid))
+    cached = None
+    if request.args.get('cached') in ('1', 'true'):
+      try:
+        cached = asset_store.get_store().get_account(int(cid))
+      except FileNotFoundError:
+        pass
+    if cached:
+      res = structure.get_account_adgroup_structure(
+          None, cid, cached,
+          structure.get_synced_at(sync_state_json_path, cid))
+    else:
+      res = structure.get_account_adgroup_structure(
+          _get_googleads_client(), cid)
+    msg = json.dumps(res)
     status = 200
   except Exception as e:
     logging.exception('could not get adgroup structure for ' + cid)
@@ -278,16 +404,33 @@ def get_account_ag_struct():
 
 @server.route('/accounts-assets/', methods=['GET'])
 def accounts_assets():
-  """if cid gets all its assets. else gets all accounts and their assets."""
+  """if cid gets all its assets. else gets all accounts and their assets.
+
+  with stream=1 and no cid, every account is sent as a separate JSON line
+  (NDJSON) as soon as its assets are ready. Pass from and to (YYYY-MM-DD) to
+  get the metrics of that date range instead of all-time metrics.
+  """
+  try:
+    date_range = _get_date_range()
+  except ValueError as e:
+    return _build_response(msg=json.dumps(str(e)), status=400)
+
   cid = request.args.get('cid')
   if cid:
-    return get_specific_accounts_assets(cid)
-  else:
+    return get_specific_accounts_assets(cid, date_range)
+  elif request.args.get('stream') in ('1', 'true'):
     return _build_response(
-      json.dumps(structure.get_all_accounts_assets(googleads_client), indent=2))
+        msg=(json.dumps(account) + '\n' for account in
+             structure.iter_all_accounts_assets(
+                 _get_googleads_client(), date_range=date_range)),
+        mimetype='application/x-ndjson')
+  else:
+    return _build_response(json.dumps(
+        structure.get_all_accounts_assets(_get_googleads_client(), date_range),
+        indent=2))
 
 
-def get_specific_accounts_assets(cid):
+def get_specific_accounts_assets(cid, date_range=None):
   """Returns all assets under the given cid."""
   # check input is valid
   if len(cid) < 10:
@@ -296,29 +439,69 @@ def get_specific_accounts_assets(cid):
 
   else:
     try:
-      res = structure.get_accounts_assets(googleads_client, cid)
+      res = structure.get_accounts_assets(
+          _get_googleads_client(), cid, date_range)
       return _build_response(msg=json.dumps(res),status=200)
     except Exception as e:
       logging.exception('Failed getting assets for: ' + cid + ' ' + str(e))
       return _build_response(status=500)
 
 
+def _get_date_range():
+  """Returns the (start, end) dates of the from/to params, or None.
+
+  Raises:
+    ValueError: if only one of them is given, or they are invalid.
+  """
+  start = request.args.get('from')
+  end = request.args.get('to')
+  if not start and not end:
+    return None
+  if not start or not end:
+    raise ValueError('both from and to are needed')
+  return metrics_cache.parse_date_range(start, end)
+
+
 @server.route('/structure/', methods=['GET'])
 def get_structure():
-  cid = int(request.args.get('cid'))
+  """Returns the structure of the cid account, or of all accounts.
+
+  Pass from and to (YYYY-MM-DD) to get the metrics of that date range instead
+  of all-time metrics.
+  """
+  cid = request.args.get('cid', type=int)
+  try:
+    date_range = _get_date_range()
+  except ValueError as e:
+    return _build_response(msg=json.dumps(str(e)), status=400)
+
   try:
-    with open(account_struct_json_path, 'r') as f:
-      accounts_struct = json.load(f)
+    store = asset_store.get_store()
+    if date_range:
+      accounts = [store.get_account(cid)] if cid else store.get_structure()
+      if accounts == [None]:
+        return _build_response(msg='cid not found', status=500)
+      accounts = structure.apply_date_range_to_accounts(
+          _get_googleads_client(), accounts, date_range)
+      return _build_response(
+          msg=json.dumps(accounts[0] if cid else accounts, indent=2))
 
     if cid:
-      for account in accounts_struct:
-        if account['id'] == cid:
-          return _build_response(msg=json.dumps(account, indent=2))
+      def build():
+        account = store.get_account(cid)
+        if account:
+          return json.dumps(account, indent=2)
+
+      cached = response_cache.get(('structure', cid), store.version(), build)
+      if cached:
+        return _build_cached_response(cached)
 
       return _build_response(msg='cid not found', status=500)
 
     else:
-      return _build_response(msg=json.dumps(accounts_struct, indent=2))
+      return _build_cached_response(response_cache.get(
+          ('structure', None), store.version(),
+          lambda: json.dumps(store.get_structure(), indent=2)))
 
   except:
     return _build_response(msg='could not get data', status=500)
@@ -326,12 +509,28 @@ def get_structure():
 
 @server.route('/assets-to-ag/', methods=['GET'])
 def get_asset_to_ag():
+  """Returns the asset to ad groups entries.
+
+  Without query params, returns all entries as a list. With any of the
+  filters (account, campaign, adgroup, type, text_type, performance), sort
+  (index, id, name or type), order (asc or desc), cursor or limit, returns a
+  single page as {'assets': [...], 'next_cursor': ...}. Paged entries have
+  their 'index' in the full list. next_cursor is passed as cursor to get the
+  next page, and is null on the last page.
+  """
   try:
-    with open(asset_to_ag_json_path, 'r') as f:
-      asset_struct = json.load(f)
+    store = asset_store.get_store()
+    if any(param in request.args for param in _ASSETS_QUERY_PARAMS):
+      return _get_asset_to_ag_page(store)
 
-    if asset_struct:
-      return _build_response(json.dumps(asset_struct))
+    def build():
+      asset_struct = store.entries()
+      if asset_struct:
+        return json.dumps(asset_struct)
+
+    cached = response_cache.get(('assets-to-ag',), store.version(), build)
+    if cached:
+      return _build_cached_response(cached)
 
     else:
       return _build_response(msg='asset structure is not available', status=501)
@@ -341,13 +540,72 @@ def get_asset_to_ag():
         msg='error while reading asset_to_ag.json: ' + str(e), status=400)
 
 
+_ASSETS_FILTERS = ['account', 'campaign', 'adgroup', 'type', 'text_type',
+                   'performance']
+_ASSETS_ID_FILTERS = ['account', 'campaign', 'adgroup']
+_ASSETS_QUERY_PARAMS = _ASSETS_FILTERS + ['sort', 'order', 'cursor', 'limit']
+_MAX_PAGE_SIZE = 5000
+_SORT_TYPES = {'index': int, 'id': int, 'name': str, 'type': str}
+
+
+def _get_asset_to_ag_page(store):
+  """Returns a page of the /assets-to-ag/ entries."""
+  filters = {}
+  for name in _ASSETS_FILTERS:
+    value = request.args.get(name)
+    if value:
+      if name in _ASSETS_ID_FILTERS:
+        if not value.isdigit():
+          return _build_response(
+              msg='invalid %s id: %s' % (name, value), status=400)
+        value = int(value)
+      filters[name] = value
+  sort = request.args.get('sort', 'index')
+  if sort not in asset_store.SORT_FIELDS:
+    return _build_response(msg='unknown sort field: ' + sort, status=400)
+  order = request.args.get('order', 'asc')
+  if order not in ('asc', 'desc'):
+    return _build_response(msg='unknown order: ' + order, status=400)
+  descending = order == 'desc'
+  try:
+    limit = int(request.args.get('limit', asset_store.DEFAULT_PAGE_SIZE))
+  except ValueError:
+    return _build_response(
+        msg='invalid limit: ' + request.args['limit'], status=400)
+  limit = max(1, min(limit, _MAX_PAGE_SIZE))
+  cursor = request.args.get('cursor')
+  if cursor:
+    try:
+      cursor = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+      cursor = None
+    # a cursor is the (sort value, index) of the previous page's last entry
+    if (not isinstance(cursor, list) or len(cursor) != 2
+        or not isinstance(cursor[0], _SORT_TYPES[sort])
+        or not isinstance(cursor[1], int)):
+      return _build_response(msg='invalid cursor', status=400)
+
+  def build():
+    page, next_cursor = store.query(
+        filters, sort=sort, descending=descending, cursor=cursor or None,
+        limit=limit)
+    if next_cursor is not None:
+      next_cursor = base64.urlsafe_b64encode(
+          json.dumps(next_cursor).encode('utf-8')).decode('ascii')
+    return json.dumps({'assets': page, 'next_cursor': next_cursor})
+
+  key = ('assets-to-ag', tuple(sorted(filters.items())), sort, descending,
+         request.args.get('cursor'), limit)
+  return _build_cached_response(
+      response_cache.get(key, store.version(), build))
+
 
 @server.route('/mutate-ad/', methods=['POST'])
 def mutate():
   """Assign or remove an asset from adgroups.
 
   gets a json file with a list of asset, account, adgourp and action.
-  preforms all of the actions one by one.
+  preforms all of the actions, changes to the same ad are sent together.
 
   returns a list withthe new asset objects with the changed adgroups list.
   if its a text asset, returns a list with
@@ -357,207 +615,181 @@ def mutate():
 
   data = request.get_json(force=True)
   logging.info('Recived mutate request: ' + str(data))
+
+  errors = _run_mutations(data)
+  result, successeful_assign, failed_assign = _asset_mutate(data, errors)
+
+  status = _mutate_status(successeful_assign, failed_assign)
+  logging.info(
+    'mutate response: msg={} , status={}'.format(result,status))
+
+  return _build_response(msg=json.dumps([result]), status=status)
+
+
+@server.route('/mutate-ads/', methods=['POST'])
+def mutate_bulk():
+  """Assign or remove several assets from adgroups.
+
+  gets the same list as /mutate-ad/, but the items may refer to different
+  assets. all the changes to the same ad are sent in a single update.
+
+  returns a list with an entry per asset, in the format of /mutate-ad/.
+  """
+  data = request.get_json(force=True)
+  logging.info('Recived bulk mutate request: ' + str(data))
+
+  errors = _run_mutations(data)
+  assets = {}
+  for item, error in zip(data, errors):
+    items, item_errors = assets.setdefault(item['asset']['id'], ([], []))
+    items.append(item)
+    item_errors.append(error)
+
+  results = []
+  successeful_assign = []
+  failed_assign = []
+  for items, item_errors in assets.values():
+    result, successes, failures = _asset_mutate(items, item_errors)
+    results.append(result)
+    successeful_assign += successes
+    failed_assign += failures
+
+  status = _mutate_status(successeful_assign, failed_assign)
+  logging.info('bulk mutate response: status={}'.format(status))
+
+  return _build_response(msg=json.dumps(results), status=status)
+
+
+def _run_mutations(data):
+  """Runs the mutations of a mutate request.
+
+  Returns a list with None for every successful item or its exception.
+  """
+  errors = mutate_ads(_get_client(), [{
+      'account': item['account'],
+      'adgroup': item['adgroup'],
+      'asset': item['asset'],
+      'action': item['action'],
+      'text_type_to_assign': item['asset'].get(
+          'text_type_to_assign', 'descriptions'),
+  } for item in data], _get_googleads_client())
+
+  for item, error in zip(data, errors):
+    if error:
+      logging.error('could not execute mutation on adgroup: '
+                    + str(item['adgroup']) + str(error))
+  return errors
+
+
+def _mutate_status(successeful_assign, failed_assign):
+  if failed_assign and successeful_assign:
+    return 206
+  elif successeful_assign:
+    return 200
+  return 500
+
+
+def _mutation_failure(adgroup, error):
+  return {
+      'adgroup': adgroup,
+      'error_message': error_mapping(str(error)),
+      'err': str(error)
+  }
+
+
+def _asset_mutate(data, errors):
+  """Updates the asset store with the results of one asset's mutations.
+
+  Returns the response entry, the succesfull adgroups and the failures.
+  """
   asset_id = data[0]['asset']['id']
   asset_type = data[0]['asset']['type']
 
-  with open(asset_to_ag_json_path, 'r') as f:
-    asset_struct = json.load(f)
+  store = asset_store.get_store()
 
   # special func for text assets, as they have 2 entries in asset_to_ag.json
   if asset_type == 'TEXT':
-    return _text_asset_mutate(data, asset_id, asset_struct)
-
-  asset_handler = {}
-  index = 0 # to re-write back to location
-  for entry in asset_struct:
-    if entry['id'] == asset_id:
-      asset_handler = entry
-      break
-    index += 1
+    return _text_asset_mutate(data, errors, asset_id, store)
 
-  if not asset_handler:
-    asset_handler = data[0]['asset']
-    asset_handler['adgroups'] = []
-    index = None
+  asset = dict(data[0]['asset'], adgroups=[])
+  index, asset_handler = store.add_links(asset, [])
 
   failed_assign = []
   successeful_assign = []
-  for item in data:
+  for item, error in zip(data, errors):
     account = item['account']
     adgroup = item['adgroup']
     action = item['action']
-    asset = item['asset']
 
-    try:
-      mutation = mutate_ad(client, account, adgroup, asset, action)
-    except Exception as e:
-      failed_assign.append(
-          {
-              'adgroup': adgroup,
-              'error_message': error_mapping(str(e)),
-              'err': str(e)
-          }
-      )
-      mutation = 'failed'
-      logging.error('could not execute mutation on adgroup: ' + str(adgroup))
-
-
-    if mutation is None:
+    if error:
+      failed_assign.append(_mutation_failure(adgroup, error))
+    else:
       successeful_assign.append(adgroup)
-      asset_handler = _asset_ag_update(asset_handler,adgroup,action)
-
-  Service_Class.reset_cid(client)
-
-  if index:
-    asset_struct[index] = asset_handler
-  else:
-    asset_struct.append(asset_handler)
-
-  with open(asset_to_ag_json_path, 'w') as f:
-    json.dump(asset_struct, f,indent=2)
-
-  if failed_assign and successeful_assign:
-    status = 206
-  elif successeful_assign:
-    status = 200
-  else:
-    status = 500
-
-  logging.info(
-    'mutate response: msg={} , status={}'.format(asset_handler,index))
+      store.assign_account(adgroup, account)
+      index, asset_handler = _asset_ag_update(store, asset, adgroup, action)
+  store.save()
 
-  return _build_response(msg=json.dumps(
-    [{'asset':asset_handler,'index':index, 'failures':failed_assign}])
-    , status=status)
+  return ({'asset':asset_handler,'index':index, 'failures':failed_assign},
+          successeful_assign, failed_assign)
 
 
-def _text_asset_mutate(data, asset_id, asset_struct):
+def _text_asset_mutate(data, errors, asset_id, store):
   """Handles text asset mutations"""
 
-  asset_handlers = []
-  index = 0 # to re-write back to location
-  for entry in asset_struct:
-    if entry['id'] == asset_id:
-      asset_handlers.append({'asset':entry, 'index':index})
-    index += 1
-
-
-  # if only one of headlines/descriptions entries
-  # exists in asset_struct, create the second one.
-  # if the asset isn't assigned to any adgroup, create both entries
-  # create headline entry only if text's len <= 30
-  if len(asset_handlers) < 2:
-    new_asset = {
-      'id': data[0]['asset']['id'],
-      'type':'TEXT',
-      'asset_text':data[0]['asset']['asset_text'],
-      'adgroups':[]
-    }
-    append = False
-    if len(data[0]['asset']['asset_text']) <= 30:
-      headline_len = True
-    else:
-      headline_len = False
-
-    if len(asset_handlers) == 1:
-      existing_type = asset_handlers[0]['asset']['text_type']
-      if existing_type == 'headlines':
-        new_asset['text_type'] = 'descriptions'
-        append = True
-      elif headline_len:
-        new_asset['text_type'] = 'headlines'
-        append = True
-      if append:
-        asset_handlers.append({'asset':new_asset, 'index':None})
-
-    elif len(asset_handlers) == 0:
-      new_asset['text_type'] = 'descriptions'
-      asset_handlers.append({'asset':new_asset, 'index':None})
-      if headline_len:
-        new_asset_second = copy.copy(new_asset)
-        new_asset_second['adgroups'] = []
-        new_asset_second['text_type'] = 'headlines'
-        asset_handlers.append({'asset':new_asset_second, 'index':None})
+  # text assets have both headlines and descriptions entries in the store,
+  # create the missing ones. create headline entry only if text's len <= 30
+  new_asset = {
+    'id': data[0]['asset']['id'],
+    'type':'TEXT',
+    'asset_text':data[0]['asset']['asset_text'],
+    'adgroups':[]
+  }
+  text_types = ['descriptions']
+  if len(data[0]['asset']['asset_text']) <= 30:
+    text_types.append('headlines')
+  for text_type in text_types:
+    store.add_links(dict(new_asset, text_type=text_type), [])
+  text_types = {entry['text_type'] for _, entry in store.find(asset_id)}
 
   successeful_assign = []
   failed_assign = []
-  for item in data:
+  for item, error in zip(data, errors):
     account = item['account']
     adgroup = item['adgroup']
     action = item['action']
-    asset = item['asset']
     text_type_to_assign = item['asset']['text_type_to_assign']
 
-    try:
-      mutation = mutate_ad(client, account, adgroup, asset, action,
-                       text_type_to_assign)
+    if error:
+      failed_assign.append(_mutation_failure(adgroup, error))
+    elif text_type_to_assign in text_types:
+      successeful_assign.append(adgroup)
+      store.assign_account(adgroup, account)
+      _asset_ag_update(store, dict(new_asset, text_type=text_type_to_assign),
+                       adgroup, action)
+  store.save()
 
-    except Exception as e:
-      failed_assign.append(
-          {
-              'adgroup': adgroup,
-              'error_message': error_mapping(str(e)),
-              'err': str(e)
-          }
-      )
-      mutation = 'failed'
-      logging.error(
-        'could not execute mutation on adgroup: ' + str(adgroup) + str(e))
-
-    if mutation is None:
-      for obj in asset_handlers:
-        if obj['asset']['text_type'] == text_type_to_assign:
-          obj['asset'] = _asset_ag_update(obj['asset'],adgroup,action)
-          successeful_assign.append(adgroup)
-
-  Service_Class.reset_cid(client)
-
-  for obj in asset_handlers:
-    if obj['index']:
-      asset_struct[obj['index']] = obj['asset']
-    else:
-      asset_struct.append(obj['asset'])
+  asset_handlers = [{'asset':entry, 'index':index}
+                    for index, entry in store.find(asset_id)]
+  return ({'asset': asset_handlers, 'failures': failed_assign},
+          successeful_assign, failed_assign)
 
-  with open(asset_to_ag_json_path, 'w') as f:
-    json.dump(asset_struct, f,indent=2)
 
-  if failed_assign and successeful_assign:
-    status = 206
-  elif successeful_assign:
-    status = 200
-  else:
-    status = 500
+def _asset_ag_update(store, asset, adgroup, action):
+  """remove or add the adgroup to the asset's store entry.
 
-  logging.info(
-    'mutate response: msg={} , status={}'.format(str(asset_handlers),index))
-  # switch to this return and tell Mariam the changed return type.
-  return _build_response(
-      msg=json.dumps(
-          [{
-              'asset': asset_handlers,
-              'failures': failed_assign
-          }]
-      ),
-      status=status)
-  # return _build_response(msg=json.dumps(asset_handlers), status=status)
-
-
-def _asset_ag_update(asset,adgroup,action):
-  """remove or add the adgroup to the asset entry"""
+  The entry is changed in place in the store, so concurrent requests don't
+  overwrite each other's changes. Returns the entry's (index, entry).
+  """
 
   if action == 'ADD':
-    asset['adgroups'].append({
+    return store.add_links(asset, [{
         "id": adgroup,
         "performance": "NEEDS UPDATE",
         "performance_type": "nontext"
-    })
-
-  if action == 'REMOVE':
-    asset['adgroups'] = [
-        item for item in asset['adgroups'] if item['id'] != adgroup]
+    }])
 
-
-  return asset
+  return store.remove_links(
+      asset['id'], asset_store.performance_type(asset), [adgroup])
 
 
 def allowed_file(filename):
@@ -642,8 +874,8 @@ def upload_asset():
 
   try:
     result = upload(
-        client,
-        googleads_client,
+        _get_client(),
+        _get_googleads_client(),
         data.get('account'),
         data.get('asset_type'),
         asset_name,
@@ -653,7 +885,7 @@ def upload_asset():
         adgroups=data.get('adgroups'))
   except Exception as e:
     logging.exception(e)
-    Service_Class.reset_cid(client)
+    Service_Class.reset_cid(_get_client())
     # Asset not uploaded
     print(str(e))
     return _build_response(msg=json.dumps(
@@ -662,7 +894,7 @@ def upload_asset():
        'err': str(e)}),
        status=400)
 
-  Service_Class.reset_cid(client)
+  Service_Class.reset_cid(_get_client())
 
   # No adgroup assignment was requested, asset uploaded successfully
   if result['status'] == -1:
@@ -698,6 +930,25 @@ def _build_response(msg='', status=200, mimetype='application/json'):
   return response
 
 
+def _build_cached_response(cached):
+  """Builds a response from the response cache, honoring ETags and gzip.
+
+  The gzipped body is a different representation, with its own strong ETag.
+  """
+  use_gzip = 'gzip' in request.accept_encodings
+  etag = cached.etag + '-gzip' if use_gzip else cached.etag
+  if request.if_none_match.contains(etag):
+    response = _build_response(status=304)
+  elif use_gzip:
+    response = _build_response(msg=cached.gzip_body)
+    response.headers['Content-Encoding'] = 'gzip'
+  else:
+    response = _build_response(msg=cached.body)
+  response.set_etag(etag)
+  response.headers['Vary'] = 'Accept-Encoding'
+  return response
+
+
 def init_clients():
   """Sets up googleads.yaml and google-ads.yaml and inits both clients.
   tries to create struct. if succesful, marks config_valid=1 in config.yaml
@@ -707,15 +958,9 @@ def init_clients():
 
   status = 0
 
-  global client
-  global googleads_client
-
   try:
 
-    client = adwords.AdWordsClient.LoadFromStorage(
-      CONFIG_PATH / 'googleads.yaml')
-    googleads_client = GoogleAdsClient.load_from_storage(
-      CONFIG_PATH / 'google-ads.yaml')
+    _load_clients()
 
     with open(CONFIG_FILE_PATH, 'r') as f:
       config = yaml.load(f, Loader=yaml.FullLoader)
@@ -750,8 +995,25 @@ def open_browser():
 
 
 def start_server():
+  # HTTP/1.1 is needed for chunked (streamed) responses
+  WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+  if startup_profile.ENABLED:
+    startup_profile.report_imports()
+    server.before_request(startup_profile.first_request)
   server.run()
 
+
+def start_desktop():
+  """Runs the app in a desktop window instead of the browser."""
+  import webview
+  threading.Thread(target=start_server, daemon=True).start()
+  webview.create_window('assetMG', 'http://127.0.0.1:5000/')
+  webview.start()
+
+
 if __name__ == '__main__':
-  threading.Timer(1, open_browser).start()
-  server.run()
+  if '--desktop' in sys.argv:
+    start_desktop()
+  else:
+    threading.Timer(1, open_browser).start()
+    start_server()
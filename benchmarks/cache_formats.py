@@ -0,0 +1,113 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the cache file formats: dump and load time, and file size.
+
+Run from the repository root:
+
+  python -m benchmarks.cache_formats [--structure app/cache/account_struct.json]
+
+Without --structure, a synthetic MCC structure is generated.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from app.backend import cache_files
+from app.backend import serialization
+
+
+def synthetic_structure(accounts=20, campaigns=10, ad_groups=10, assets=20):
+  """Returns a structure shaped like account_struct.json."""
+  rng = random.Random(0)
+  asset_id = 0
+  structure = []
+  for account in range(accounts):
+    account_struct = {'id': 1000000000 + account,
+                      'name': 'Account %d' % account, 'campaigns': []}
+    for campaign in range(campaigns):
+      campaign_struct = {'id': 100000 * account + campaign,
+                         'campaign_name': 'App campaign %d' % campaign,
+                         'status': 'ENABLED', 'adgroups': []}
+      for ad_group in range(ad_groups):
+        ad_group_struct = {'id': 1000 * campaign_struct['id'] + ad_group,
+                           'name': 'Ad group %d' % ad_group,
+                           'status': 'ENABLED', 'assets': []}
+        for _ in range(assets):
+          asset_id += 1
+          ad_group_struct['assets'].append({
+              'id': asset_id,
+              'name': 'asset %d' % asset_id,
+              'type': 'TEXT',
+              'stats': {
+                  'clicks': rng.randint(0, 10000),
+                  'all_conversions': rng.random() * 100,
+                  'impressions': rng.randint(0, 1000000),
+                  'cost': rng.randint(0, 10000000) / 1000000,
+              },
+              'performance': rng.choice(['GOOD', 'BEST', 'LOW', 'LEARNING']),
+              'text_type': 'headlines',
+              'asset_text': 'Install the best app of the store %d' % asset_id,
+          })
+        campaign_struct['adgroups'].append(ad_group_struct)
+      account_struct['campaigns'].append(campaign_struct)
+    structure.append(account_struct)
+  return structure
+
+
+def _timed(fn, repeat):
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--structure', help='account_struct.json to use')
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  if args.structure:
+    structure = cache_files.read_structure(args.structure)
+  else:
+    structure = synthetic_structure()
+  middle_id = structure[len(structure) // 2]['id']
+
+  print('%-14s %10s %10s %12s %12s' % (
+      'format', 'dump (s)', 'load (s)', 'account (ms)', 'size (KB)'))
+  with tempfile.TemporaryDirectory() as tmp:
+    for name in serialization.FORMATS:
+      if serialization.get_format(name).name != name:
+        print('%-14s skipped, msgpack is not installed' % name)
+        continue
+      os.environ['ASSETMG_CACHE_FORMAT'] = name
+      path = os.path.join(tmp, 'account_struct.' + name)
+      dump = _timed(
+          lambda: cache_files.write_structure(path, structure), args.repeat)
+      load = _timed(lambda: cache_files.read_structure(path), args.repeat)
+      account = _timed(
+          lambda: cache_files.read_account(path, middle_id), args.repeat)
+      print('%-14s %10.3f %10.3f %12.2f %12d' % (
+          name, dump, load, account * 1000, os.stat(path).st_size // 1024))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,309 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-in for the GoogleAdsClient, for benchmarks.
+
+FakeGoogleAdsClient serves GoogleAdsService.search_stream for the queries of
+app/backend/structure.py with a synthetic MCC of the given size. Rows are
+shaped like the v4 GoogleAdsRow (wrapped values, enums as ints) and are
+generated batch by batch, deterministically, so the same MCC is served by
+every query and the fake itself holds little memory.
+
+Requests can be slowed down with latency (per request) and batch_latency (per
+batch), and a fraction error_rate of them fails with a quota error, which the
+app retries.
+"""
+
+import datetime
+import random
+import re
+import threading
+import time
+import types
+
+
+ENUMS = {
+    'AssetTypeEnum': [
+        'UNSPECIFIED', 'UNKNOWN', 'YOUTUBE_VIDEO', 'MEDIA_BUNDLE', 'IMAGE',
+        'TEXT'],
+    'AssetFieldTypeEnum': [
+        'UNSPECIFIED', 'UNKNOWN', 'HEADLINE', 'DESCRIPTION',
+        'MANDATORY_AD_TEXT', 'MARKETING_IMAGE', 'MEDIA_BUNDLE',
+        'YOUTUBE_VIDEO'],
+    'AdGroupStatusEnum': [
+        'UNSPECIFIED', 'UNKNOWN', 'ENABLED', 'PAUSED', 'REMOVED'],
+    'CampaignStatusEnum': [
+        'UNSPECIFIED', 'UNKNOWN', 'ENABLED', 'PAUSED', 'REMOVED'],
+    'AssetPerformanceLabelEnum': [
+        'UNSPECIFIED', 'UNKNOWN', 'PENDING', 'LEARNING', 'LOW', 'GOOD',
+        'BEST'],
+}
+
+_TYPE = {name: i for i, name in enumerate(ENUMS['AssetTypeEnum'])}
+_FIELD_TYPE = {name: i for i, name in enumerate(ENUMS['AssetFieldTypeEnum'])}
+_ENABLED, _PAUSED = 2, 3
+# assets of an account, per ad group asset slot: ad groups share assets
+_ASSET_REUSE = 3
+# assets of an account that aren't in any ad group
+_UNLINKED_ASSETS = 0.1
+
+_FROM = re.compile(r'FROM\s+(\w+)')
+_CAMPAIGN_IDS = re.compile(r'campaign\.id IN \(([\d, ]+)\)')
+_AD_GROUP_ID = re.compile(r'ad_group\.id = (\d+)')
+_DATES = re.compile(r"segments\.date BETWEEN '([\d-]+)' AND '([\d-]+)'")
+
+
+class Value(object):
+  """A wrapped value, like google.protobuf.Int64Value."""
+
+  __slots__ = ['value']
+
+  def __init__(self, value):
+    self.value = value
+
+
+def _ns(**fields):
+  return types.SimpleNamespace(**fields)
+
+
+class FakeEnum(object):
+
+  def __init__(self, names):
+    self._names = names
+
+  def Name(self, number):  # pylint: disable=invalid-name
+    if not 0 <= number < len(self._names):
+      raise ValueError('unknown enum value %s' % number)
+    return self._names[number]
+
+  def items(self):
+    return [(name, number) for number, name in enumerate(self._names)]
+
+
+class QuotaError(Exception):
+  """Quota error, as rate_limit.throttle_delay recognizes it."""
+
+  def __init__(self):
+    super().__init__('RESOURCE_EXHAUSTED: Retry in 0 seconds')
+
+  def code(self):
+    return _ns(name='RESOURCE_EXHAUSTED')
+
+
+class FakeGoogleAdsService(object):
+  """search_stream over a synthetic MCC, see FakeGoogleAdsClient."""
+
+  def __init__(self, accounts, campaigns, ad_groups, assets, batch_size,
+               latency, batch_latency, error_rate, seed):
+    self._accounts = accounts
+    self._campaigns = campaigns
+    self._ad_groups = ad_groups
+    self._assets = assets
+    self._batch_size = batch_size
+    self._latency = latency
+    self._batch_latency = batch_latency
+    self._error_rate = error_rate
+    self._seed = seed
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.errors = 0
+    self.rows = 0
+
+  def search_stream(self, customer_id, query):
+    return self._stream(int(customer_id), query)
+
+  def _stream(self, customer_id, query):
+    # nothing happens until the first batch is read, as with the real stream
+    with self._lock:
+      self.requests += 1
+      failed = self._random.random() < self._error_rate
+      if failed:
+        self.errors += 1
+    if self._latency:
+      time.sleep(self._latency)
+    if failed:
+      raise QuotaError()
+
+    resource = _FROM.search(query).group(1)
+    rows = getattr(self, '_rows_' + resource)(customer_id, query)
+    batch = []
+    for row in rows:
+      batch.append(row)
+      if len(batch) == self._batch_size:
+        yield self._batch(batch)
+        batch = []
+    if batch:
+      yield self._batch(batch)
+
+  def _batch(self, rows):
+    with self._lock:
+      self.rows += len(rows)
+    if self._batch_latency:
+      time.sleep(self._batch_latency)
+    return _ns(results=rows)
+
+  def account_ids(self):
+    return [1000000000 + i for i in range(self._accounts)]
+
+  def _campaign_ids(self, customer_id, query):
+    first = (customer_id - 1000000000) * 1000
+    ids = range(first, first + self._campaigns)
+    match = _CAMPAIGN_IDS.search(query)
+    if match:
+      selected = {int(i) for i in match.group(1).split(',')}
+      ids = [i for i in ids if i in selected]
+    return ids
+
+  def _ad_group_ids(self, campaign_id, query):
+    ids = range(campaign_id * 1000, campaign_id * 1000 + self._ad_groups)
+    match = _AD_GROUP_ID.search(query)
+    if match:
+      ids = [i for i in ids if i == int(match.group(1))]
+    return ids
+
+  def _account_assets(self, customer_id):
+    """Returns the number of assets in ad groups, and in all, of an account."""
+    linked = max(1, self._campaigns * self._ad_groups * self._assets
+                 // _ASSET_REUSE)
+    return linked, int(linked * (1 + _UNLINKED_ASSETS))
+
+  def _asset_fields(self, customer_id, number):
+    """Returns the fields of an account's asset and its field type."""
+    asset_id = (customer_id % 1000000 + 1) * 10000000 + number
+    rng = random.Random(asset_id ^ self._seed)
+    kind = rng.random()
+    if kind < 0.6:
+      asset_type = _TYPE['TEXT']
+      field_type = _FIELD_TYPE['HEADLINE' if kind < 0.4 else 'DESCRIPTION']
+    elif kind < 0.85:
+      asset_type = _TYPE['IMAGE']
+      field_type = _FIELD_TYPE['MARKETING_IMAGE']
+    else:
+      asset_type = _TYPE['YOUTUBE_VIDEO']
+      field_type = _FIELD_TYPE['YOUTUBE_VIDEO']
+    asset = _ns(
+        id=Value(asset_id),
+        name=Value('Asset %d' % asset_id),
+        type=asset_type,
+        image_asset=_ns(
+            file_size=Value(rng.randint(10000, 500000)),
+            full_size=_ns(
+                url=Value('https://tpc.googlesyndication.com/simgad/%d'
+                          % asset_id),
+                height_pixels=Value(rng.choice([628, 1080, 1200])),
+                width_pixels=Value(rng.choice([1080, 1200])))),
+        text_asset=_ns(text=Value('Install the best app %d' % asset_id)),
+        youtube_video_asset=_ns(
+            youtube_video_id=Value('vid%08d' % (asset_id % 100000000))))
+    return asset, field_type
+
+  def _rows_customer_client(self, customer_id, query):
+    for account_id in self.account_ids():
+      yield _ns(customer_client=_ns(
+          id=Value(account_id),
+          descriptive_name=Value('Account %d' % account_id)))
+
+  def _rows_campaign(self, customer_id, query):
+    for campaign_id in self._campaign_ids(customer_id, query):
+      yield _ns(campaign=self._campaign_fields(campaign_id))
+
+  def _campaign_fields(self, campaign_id):
+    return _ns(id=Value(campaign_id),
+               name=Value('App campaign %d' % campaign_id),
+               status=_PAUSED if campaign_id % 7 == 6 else _ENABLED)
+
+  def _rows_ad_group(self, customer_id, query):
+    for campaign_id in self._campaign_ids(customer_id, query):
+      campaign = self._campaign_fields(campaign_id)
+      for ad_group_id in self._ad_group_ids(campaign_id, query):
+        yield _ns(campaign=campaign, ad_group=_ns(
+            id=Value(ad_group_id),
+            name=Value('Ad group %d' % ad_group_id),
+            status=_PAUSED if ad_group_id % 9 == 8 else _ENABLED))
+
+  def _rows_ad_group_ad_asset_view(self, customer_id, query):
+    linked, _ = self._account_assets(customer_id)
+    days = [None]
+    match = _DATES.search(query)
+    if match:
+      start, end = (datetime.date.fromisoformat(d) for d in match.groups())
+      days = [(start + datetime.timedelta(days=i)).isoformat()
+              for i in range((end - start).days + 1)]
+    for campaign_id in self._campaign_ids(customer_id, query):
+      campaign = _ns(id=Value(campaign_id))
+      for ad_group_id in self._ad_group_ids(campaign_id, query):
+        rng = random.Random(ad_group_id ^ self._seed)
+        ad_group = _ns(id=Value(ad_group_id))
+        for number in rng.sample(range(linked), min(self._assets, linked)):
+          asset, field_type = self._asset_fields(customer_id, number)
+          view = _ns(field_type=field_type,
+                     performance_label=rng.randint(2, 6))
+          for day in days:
+            scale = 1 if day is None else 30
+            impressions = rng.randint(0, 1000000) // scale
+            clicks = impressions // rng.randint(20, 200)
+            yield _ns(
+                campaign=campaign, ad_group=ad_group, asset=asset,
+                ad_group_ad_asset_view=view,
+                segments=_ns(date=Value(day or '')),
+                metrics=_ns(
+                    impressions=Value(impressions),
+                    clicks=Value(clicks),
+                    all_conversions=Value(clicks * rng.random() / 10),
+                    cost_micros=Value(clicks * rng.randint(10000, 2000000))))
+
+  def _rows_asset(self, customer_id, query):
+    _, total = self._account_assets(customer_id)
+    for number in range(total):
+      yield _ns(asset=self._asset_fields(customer_id, number)[0])
+
+  def _rows_change_status(self, customer_id, query):
+    return iter(())
+
+
+
+class FakeGoogleAdsClient(object):
+  """GoogleAdsClient serving a synthetic MCC.
+
+  Args:
+    accounts: number of accounts of the MCC.
+    campaigns: campaigns per account.
+    ad_groups: ad groups per campaign.
+    assets: assets per ad group. Every account has a third as many assets as
+      ad group asset slots, so assets are shared by ad groups, and a tenth
+      more that aren't in any ad group.
+    batch_size: rows per search_stream batch, 10000 like the API.
+    latency: seconds before the first batch of every request.
+    batch_latency: seconds before every batch.
+    error_rate: fraction of the requests failing with a quota error.
+    seed: seed of the generated MCC and of the errors.
+  """
+
+  def __init__(self, accounts=10, campaigns=5, ad_groups=10, assets=20,
+               batch_size=10000, latency=0, batch_latency=0, error_rate=0,
+               seed=0):
+    self.login_customer_id = 999
+    self.service = FakeGoogleAdsService(
+        accounts, campaigns, ad_groups, assets, batch_size, latency,
+        batch_latency, error_rate, seed)
+
+  def get_service(self, name, version=None):
+    if name != 'GoogleAdsService':
+      raise ValueError('%s is not faked' % name)
+    return self.service
+
+  def get_type(self, name, version=None):
+    # e.g. get_type('AssetTypeEnum').AssetType
+    return _ns(**{name[:-len('Enum')]: FakeEnum(ENUMS[name])})
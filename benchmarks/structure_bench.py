@@ -0,0 +1,190 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks the structure builders against a synthetic MCC.
+
+Runs create_mcc_struct, get_all_accounts_assets and
+get_account_adgroup_structure (for every account) on a FakeGoogleAdsClient
+and reports their wall time, rows per second and peak memory. Run from the
+repository root:
+
+  python -m benchmarks.structure_bench --save-baseline baseline.json
+  ... change the code ...
+  python -m benchmarks.structure_bench --baseline baseline.json
+
+Exits with status 1 if a scenario is slower, or uses more memory, than the
+baseline by more than --tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from app.backend import rate_limit
+from app.backend import structure
+from benchmarks.fake_ads import FakeGoogleAdsClient
+
+
+def _create_mcc_struct(client):
+  with tempfile.TemporaryDirectory() as tmp:
+    structure.create_mcc_struct(
+        client, os.path.join(tmp, 'account_struct.json'),
+        os.path.join(tmp, 'asset_to_ag.json'),
+        os.path.join(tmp, 'sync_state.json'))
+
+
+def _get_all_accounts_assets(client):
+  structure.get_all_accounts_assets(client)
+
+
+def _get_account_adgroup_structure(client):
+  for account_id in client.service.account_ids():
+    structure.get_account_adgroup_structure(client, str(account_id))
+
+
+SCENARIOS = {
+    'create_mcc_struct': _create_mcc_struct,
+    'get_all_accounts_assets': _get_all_accounts_assets,
+    'get_account_adgroup_structure': _get_account_adgroup_structure,
+}
+CONFIG = ['accounts', 'campaigns', 'ad_groups', 'assets', 'batch_size',
+          'latency', 'batch_latency', 'error_rate', 'max_qps']
+
+
+def _client(args):
+  # every run starts with a fresh limiter, so runs don't affect each other
+  rate_limit.limiter = rate_limit.RateLimiter(rate=args.max_qps)
+  return FakeGoogleAdsClient(
+      accounts=args.accounts, campaigns=args.campaigns,
+      ad_groups=args.ad_groups, assets=args.assets,
+      batch_size=args.batch_size, latency=args.latency,
+      batch_latency=args.batch_latency, error_rate=args.error_rate)
+
+
+def run(name, args):
+  """Runs a scenario, returns its results."""
+  scenario = SCENARIOS[name]
+  best = None
+  for _ in range(args.repeat):
+    client = _client(args)
+    start = time.perf_counter()
+    scenario(client)
+    seconds = time.perf_counter() - start
+    if best is None or seconds < best['seconds']:
+      service = client.service
+      best = {
+          'seconds': round(seconds, 4),
+          'rows': service.rows,
+          'rows_per_second': round(service.rows / seconds),
+          'requests': service.requests,
+          'errors': service.errors,
+      }
+
+  if args.memory:
+    # a separate run, tracing allocations slows the code down
+    client = _client(args)
+    tracemalloc.start()
+    scenario(client)
+    best['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+    tracemalloc.stop()
+  return best
+
+
+def compare(results, baseline, tolerance):
+  """Prints the changes from the baseline, returns the regressed scenarios."""
+  regressions = []
+  print('\nCompared to the baseline:')
+  for name, result in results.items():
+    base = baseline['results'].get(name)
+    if not base:
+      print('  %-30s not in the baseline' % name)
+      continue
+    changes = []
+    for metric in ('seconds', 'peak_mb'):
+      if metric not in result or metric not in base or not base[metric]:
+        continue
+      ratio = result[metric] / base[metric]
+      regressed = ratio > 1 + tolerance
+      changes.append('%s %+.1f%%%s' % (
+          metric, (ratio - 1) * 100, ' REGRESSION' if regressed else ''))
+      if regressed:
+        regressions.append(name)
+    print('  %-30s %s' % (name, ', '.join(changes)))
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                      help='scenario to run, all by default')
+  parser.add_argument('--accounts', type=int, default=20)
+  parser.add_argument('--campaigns', type=int, default=10,
+                      help='campaigns per account')
+  parser.add_argument('--ad-groups', type=int, default=10,
+                      help='ad groups per campaign')
+  parser.add_argument('--assets', type=int, default=20,
+                      help='assets per ad group')
+  parser.add_argument('--batch-size', type=int, default=10000)
+  parser.add_argument('--latency', type=float, default=0,
+                      help='seconds before the first batch of a request')
+  parser.add_argument('--batch-latency', type=float, default=0,
+                      help='seconds before every batch')
+  parser.add_argument('--error-rate', type=float, default=0,
+                      help='fraction of the requests failing with a quota '
+                      'error')
+  parser.add_argument('--max-qps', type=float, default=1000,
+                      help='request rate of the limiter')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='runs per scenario, the fastest is reported')
+  parser.add_argument('--no-memory', dest='memory', action='store_false',
+                      help="don't measure peak memory")
+  parser.add_argument('--baseline', help='results file to compare with')
+  parser.add_argument('--save-baseline', help='file to save the results to')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='slowdown or memory growth reported as regression')
+  args = parser.parse_args()
+  # the builders log every request
+  logging.getLogger().setLevel(logging.WARNING)
+
+  config = {name: getattr(args, name) for name in CONFIG}
+  print('MCC: %(accounts)d accounts x %(campaigns)d campaigns x '
+        '%(ad_groups)d ad groups x %(assets)d assets' % config)
+  print('%-30s %9s %9s %11s %9s %9s' % (
+      'scenario', 'wall (s)', 'rows', 'rows/s', 'requests', 'peak (MB)'))
+  results = {}
+  for name in args.scenario or SCENARIOS:
+    result = results[name] = run(name, args)
+    print('%-30s %9.3f %9d %11d %9d %9s' % (
+        name, result['seconds'], result['rows'], result['rows_per_second'],
+        result['requests'], result.get('peak_mb', '-')))
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as f:
+      json.dump({'config': config, 'results': results}, f, indent=2)
+  if args.baseline:
+    with open(args.baseline, 'r') as f:
+      baseline = json.load(f)
+    if baseline['config'] != config:
+      print('\nWarning: the baseline was run with %s' % baseline['config'])
+    if compare(results, baseline, args.tolerance):
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()